@@ -14,55 +14,238 @@ Docstring для app.masscan_scaner
 
 # Imports
 import json
-from typing import List, Dict, Any
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import fastjsonschema
+from typing import List, Dict, Any, Tuple, Optional, AsyncIterator, Callable
+from dataclasses import dataclass
 import logging
+import logging.handlers
+import queue
+import atexit
 import sys
 from telegram import Bot
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 import asyncio
-from datetime import datetime
-import nmap
+import contextlib
+import hashlib
+import html
+import ipaddress
+import random
+import signal
+import time
+import xml.etree.ElementTree as ET
 import subprocess
+import shutil
+import tempfile
 from pathlib import Path
+from array import array
 import os
 from dotenv import load_dotenv
+import requests
+
+try:
+    import numpy as np
+except ImportError:  # numpy не установлен - новые порты ищутся через set
+    np = None
+
+try:
+    import orjson
+except ImportError:  # orjson не установлен - конфиг и история читаются и пишутся стандартным json
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop не установлен (или Windows) - используется стандартный цикл событий asyncio
+    uvloop = None
+
+
+def _json_loads(data: bytes) -> Any:
+    """Разбор JSON: orjson при наличии, иначе стандартный json."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False, newline: bool = False) -> bytes:
+    """
+    Сериализация в JSON (bytes): orjson при наличии, иначе стандартный json.
+    Числовые ключи приводятся к строкам, indent - отступ в 2 пробела, newline - перевод строки в конце.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if newline:
+            option |= orjson.OPT_APPEND_NEWLINE
+        return orjson.dumps(obj, option=option)
+    data = json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+    return data + b"\n" if newline else data
 
 
 
 # === 1. Logging Setup === 
+# Фоновый поток записи логов (см. setup_logging); None - логирование не настроено или уже остановлено
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
 def setup_logging():
-    """Настройка логирования для приложения в файл и консоль."""
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler("scan.log", encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    """
+    Настройка логирования для приложения в файл и консоль.
+    Запись в файл и консоль выполняет фоновый поток (QueueListener): вызов logging
+    в цикле событий только кладёт запись в очередь и не блокируется на вводе-выводе.
+    Повторный вызов ничего не меняет.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [
+        # delay=True: файл открывается при первой записи, а не при настройке логирования
+        logging.FileHandler("scan.log", encoding='utf-8', delay=True),
+        logging.StreamHandler(sys.stdout)
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    # Если shutdown_logging не был вызван явно, поток останавливается при выходе из процесса
+    atexit.register(shutdown_logging)
+    
+    # В очередь попадает только текст сообщения (с трассировкой исключения); время и уровень добавляет formatter
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
     
     # Подавляем INFO-логи от httpx (используется python-telegram-bot)
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
+def shutdown_logging():
+    """Запись оставшихся в очереди сообщений, остановка фонового потока и закрытие файлов логов."""
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    _log_listener = None
+    logging.shutdown()
+
+
+@lru_cache(maxsize=1)
+def _format_ts(second: int) -> str:
+    """Форматирование времени с точностью до секунды (результат кэшируется)."""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+
+
+def _now_str() -> str:
+    """
+    Текущее время строкой '%Y-%m-%d %H:%M:%S'.
+    strftime выполняется не чаще раза в секунду: в пределах одной секунды возвращается та же строка.
+    """
+    return _format_ts(int(time.time()))
+
+
 # === 2. Config Class === 
+# Схема конфига: компилируется в функцию проверки один раз при импорте
+_CONFIG_SCHEMA = {
+    "type": "object",
+    "required": ["scan_target", "masscan_config", "telegram", "schedule"],
+    "properties": {
+        "scan_target": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["target", "ports"],
+                "properties": {
+                    "name": {"type": "string"},
+                    "target": {"type": "string", "minLength": 1},
+                    "ports": {"type": "string", "minLength": 1}
+                }
+            }
+        },
+        "max_concurrent_targets": {"type": "integer", "minimum": 1},
+        "nmap_concurrency": {"type": "integer", "minimum": 1},
+        "masscan_config": {
+            "type": "object",
+            "properties": {
+                "rate": {"type": "integer", "minimum": 1},
+                "timeout": {"type": "number", "exclusiveMinimum": 0},
+                "auth_wrapper": {"type": "array", "items": {"type": "string"}},
+                "shards": {"type": "integer", "minimum": 1},
+                "adapter_port": {"type": "integer", "minimum": 1, "maximum": 65535}
+            }
+        },
+        "telegram": {"type": "object"},
+        "schedule": {
+            "type": "object",
+            "properties": {
+                "enabled": {"type": "boolean"},
+                "interval_hours": {"type": "number", "exclusiveMinimum": 0}
+            }
+        }
+    }
+}
+_validate_config = fastjsonschema.compile(_CONFIG_SCHEMA)
+
+
+@lru_cache(maxsize=8)
+def _read_config_file(config_file: str, mtime_ns: int) -> dict:
+    """
+    Чтение и парсинг файла конфигурации.
+    Кэш привязан к пути и mtime файла: повторные Config() не перечитывают диск,
+    а изменение файла автоматически даёт новый ключ кэша.
+    """
+    with open(config_file, 'rb') as f:
+        return _json_loads(f.read())
+
+
 class Config:
     """
     Класс для загрузки и управления конфигурацией сканирования.
     Загрузка конфига при помощи _load_config и базовая валидация в _validate.
-    Предоставляет свойства для доступа к параметрам конфигурации.
+    Параметры конфигурации извлекаются один раз при создании и хранятся
+    в обычных атрибутах (__slots__), без обращения к словарю при каждом чтении.
     """
+    
+    __slots__ = (
+        "config_file", "data",
+        "scan_targets", "max_concurrent_targets", "nmap_concurrency",
+        "masscan_rate", "masscan_timeout", "masscan_auth_wrapper", "masscan_shards", "masscan_adapter_port",
+        "telegram_token", "telegram_chat_id", "schedule_enabled", "schedule_interval_hours",
+    )
 
     def __init__(self, config_file: str = "config.json"):
         self.config_file = config_file
         self.data = self._load_config()
         self._validate()
         
+        masscan_config = self.data["masscan_config"]
+        telegram_config = self.data["telegram"]
+        schedule_config = self.data["schedule"]
+        self.scan_targets: List[Dict[str, Any]] = self.data["scan_target"]
+        self.max_concurrent_targets: int = self.data.get("max_concurrent_targets", 4)
+        self.nmap_concurrency: int = self.data.get("nmap_concurrency", 6)
+        self.masscan_rate: int = masscan_config.get("rate", 1000)
+        # Ограничение времени работы masscan для цели; без timeout в конфиге не ограничивается
+        self.masscan_timeout: Optional[float] = masscan_config.get("timeout")
+        self.masscan_auth_wrapper: List[str] = masscan_config.get("auth_wrapper", [])
+        self.masscan_shards: int = masscan_config.get("shards", 1)
+        self.masscan_adapter_port: int = masscan_config.get("adapter_port")
+        self.telegram_token: str = telegram_config.get("bot_token", "")
+        self.telegram_chat_id: str = telegram_config.get("chat_id", "")
+        self.schedule_enabled: bool = schedule_config.get("enabled", False)
+        self.schedule_interval_hours: int = schedule_config.get("interval_hours", 24)
+        
     def _load_config(self) -> dict:
-        """Загружает конфигурацию из JSON файла."""
+        """Загружает конфигурацию из JSON файла (с кэшем по времени изменения файла)."""
         try:
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return _read_config_file(self.config_file, os.stat(self.config_file).st_mtime_ns)
         except FileNotFoundError:
             logging.error(f"Конфиг файл: {self.config_file} - не найден.")
             sys.exit(1)
@@ -71,75 +254,243 @@ class Config:
             sys.exit(1)
             
     def _validate(self):
-        """Базовая валидация конфигурации."""
-        required_keys = ["scan_target", "masscan_config", "telegram", "schedule"]
-        for key in required_keys:
-            if key not in self.data:
-                raise ValueError(f"Отсутствует обязательный ключ в конфиге: {key}")
-            
-        if not self.data["scan_target"]:
-            raise ValueError("Список scan_targets не может быть пустым.")
-        
-        if not isinstance(self.data["scan_target"], list):
-            raise ValueError("scan_target должен быть списком.")
-    
-    @property
-    def scan_targets(self) -> List[Dict[str, Any]]:
-        return self.data["scan_target"]
-    
-    @property
-    def scan_target_name(self) -> str:
-        return self.data["scan_target"].get("name", "Unknown")
-    
-    @property
-    def scan_ports(self) -> str:
-        return self.data["scan_target"]["ports"]
-    
-    @property
-    def masscan_rate(self) -> int:
-        return self.data["masscan_config"].get("rate", 1000)
-    
-    @property
-    def masscan_timeout(self) -> int:
-        return self.data["masscan_config"].get("timeout", 30)
-        
-    @property
-    def telegram_token(self) -> str:
-        return self.data["telegram"].get("bot_token", "")
-    
-    @property
-    def telegram_chat_id(self) -> str:
-        return self.data["telegram"].get("chat_id", "")
+        """Базовая валидация конфигурации по схеме _CONFIG_SCHEMA."""
+        try:
+            _validate_config(self.data)
+        except fastjsonschema.JsonSchemaException as e:
+            raise ValueError(f"Некорректный конфиг: {e.message}") from e
+
+
+# === 3. Telegram Notifier Class ===
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Экземпляры Bot по токену: один пул HTTPS-соединений на процесс
+_telegram_bots: Dict[str, Bot] = {}
+
+# Лимиты Telegram Bot API с запасом: не более 30 сообщений в секунду всего и 20 в минуту в группу
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_CHAT_PER_MINUTE = 18
+
+# Сообщения, поставленные в очередь в течение этого окна (сек), отправляются одним сообщением Telegram
+TELEGRAM_BATCH_INTERVAL = 3.0
+TELEGRAM_BATCH_SEPARATOR = "\n---\n"
+
+
+class _TokenBucket:
+    """
+    Ограничение частоты отправки: rate токенов в секунду, не более burst подряд.
+    Используется только фоновой задачей отправки, поэтому блокировка не нужна.
+    """
     
-    @property
-    def schedule_enabled(self) -> bool:
-        return self.data["schedule"].get("enabled", False)
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
     
-    @property
-    def schedule_interval_hours(self) -> int:
-        return self.data["schedule"].get("interval_hours", 24)
+    async def acquire(self):
+        """Ожидание свободного токена."""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
 
 
-# === 3. Telegram Notifier Class ===
 class TelegramNotifier:
-    """Отправка уведомлений через Telegram в бота."""
+    """
+    Отправка уведомлений через Telegram в бота.
+    Сообщения отправляются с parse_mode='HTML', поэтому баннеры сервисов (текст удалённой стороны),
+    названия и адреса целей экранируются html.escape.
+    """
+    
+    # Постоянные части сообщений: заголовки собираются одним format()
+    _NEW_PORTS_HEADER = (
+        "<b>Обнаружены новые открытые порты!</b>\n\n"
+        "<b>IP:</b> {ip}\n"
+        "<b>Время:</b> {ts}\n\n"
+        "<b>Новые порты ({count}):</b>\n"
+    )
+    _NEW_PORT_LINE = " - Порт {port}/tcp: {service}\n"
+    _SCAN_COMPLETE = (
+        "<b>Сканирование завершено!</b>\n\n"
+        "<b>Цель:</b> {target_name}\n"
+        "<b>Всего открытых портов:</b> {total_ports}\n"
+        "<b>Время:</b> {ts}\n"
+    )
     
     def __init__(self):
         self._bot = None
+        # HTTP-сессия запасной синхронной отправки: соединение с api.telegram.org переиспользуется
+        self._sync_session = requests.Session()
         load_dotenv()
         self._bot_token = os.getenv("TELEGRAM_API_TOKEN")
         self._chat_id = os.getenv("TELEGRAM_CHAT_ID")
+        # Очередь исходящих сообщений (текст, future с результатом) и фоновая задача её отправки
+        self._queue: asyncio.Queue = None
+        self._worker: asyncio.Task = None
+        # Запрос немедленной отправки накопленных сообщений, без ожидания окна TELEGRAM_BATCH_INTERVAL
+        self._flush_now: asyncio.Event = None
+        # Сообщение, не поместившееся в предыдущую пачку: отправляется первым в следующей
+        self._carry: Tuple[str, Optional[asyncio.Future]] = None
+        self._global_bucket = _TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chat_bucket = _TokenBucket(TELEGRAM_CHAT_PER_MINUTE / 60, TELEGRAM_CHAT_PER_MINUTE)
         
     async def _get_bot(self):
-        """Инициализация бота асинхронно."""
+        """
+        Инициализация бота асинхронно.
+        Bot с общим пулом соединений переиспользуется всеми уведомлениями,
+        чтобы не выполнять TLS-рукопожатие на каждое сообщение.
+        """
         if not self._bot:
-            self._bot = Bot(token=self._bot_token)
+            bot = _telegram_bots.get(self._bot_token)
+            if bot is None:
+                request = HTTPXRequest(connection_pool_size=32, connect_timeout=5.0, pool_timeout=1.0)
+                bot = Bot(token=self._bot_token, request=request)
+                _telegram_bots[self._bot_token] = bot
+            self._bot = bot
         return self._bot
     
-    async def send_message(self, message: str) -> bool:
-        """Отправка сообщения в Telegram чат асинхронно."""
+    @staticmethod
+    def _split_message(message: str) -> List[str]:
+        """Разбиение сообщения на части не длиннее лимита Telegram по границам строк."""
+        if len(message) <= TELEGRAM_MESSAGE_LIMIT:
+            return [message]
+        
+        chunks = []
+        current = ""
+        for line in message.splitlines(keepends=True):
+            # Строка длиннее лимита режется принудительно
+            while len(line) > TELEGRAM_MESSAGE_LIMIT:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(line[:TELEGRAM_MESSAGE_LIMIT])
+                line = line[TELEGRAM_MESSAGE_LIMIT:]
+            if len(current) + len(line) > TELEGRAM_MESSAGE_LIMIT:
+                chunks.append(current)
+                current = ""
+            current += line
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    async def send_message(self, message: str, flush: bool = False, wait: bool = True) -> bool:
+        """
+        Отправка сообщения в Telegram чат асинхронно (длинные сообщения делятся на части).
+        Части ставятся в общую очередь и отправляются с учётом лимитов Telegram.
+        flush - отправить накопленные в очереди сообщения сразу, не дожидаясь окна объединения.
+        wait=False - только поставить в очередь, не дожидаясь отправки (и окна объединения):
+        ошибки отправки в этом случае только пишутся в лог, результат всегда True.
+        """
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._flush_now = asyncio.Event()
+            self._worker = asyncio.create_task(self._drain())
+        
+        loop = asyncio.get_running_loop()
+        futures = []
+        for chunk in self._split_message(message):
+            future = loop.create_future() if wait else None
+            self._queue.put_nowait((chunk, future))
+            futures.append(future)
+        if flush:
+            self._flush_now.set()
+        if not wait:
+            return True
+        return all(await asyncio.gather(*futures))
+    
+    async def close(self):
+        """Ожидание отправки всех сообщений очереди (в том числе поставленных с wait=False)."""
+        if self._worker is None or self._worker.done():
+            return
+        self._flush_now.set()
+        await self._queue.join()
+    
+    def _take_batch(self, first: Tuple[str, Optional[asyncio.Future]]) -> List[Tuple[str, Optional[asyncio.Future]]]:
+        """
+        Сообщения из очереди, которые помещаются вместе с first в одно сообщение Telegram.
+        Порядок сохраняется: первое не поместившееся сообщение откладывается в self._carry.
+        """
+        batch = [first]
+        size = len(first[0])
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            size += len(TELEGRAM_BATCH_SEPARATOR) + len(item[0])
+            if size > TELEGRAM_MESSAGE_LIMIT:
+                self._carry = item
+                break
+            batch.append(item)
+        return batch
+    
+    async def _drain(self):
+        """
+        Фоновая отправка сообщений из очереди: не чаще лимитов, без HTTP 429 и повторов.
+        Сообщения, накопившиеся за TELEGRAM_BATCH_INTERVAL, отправляются одним запросом.
+        """
+        while True:
+            if self._carry is not None:
+                # Окно объединения для отложенного сообщения уже прошло
+                first, self._carry = self._carry, None
+            else:
+                first = await self._queue.get()
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._flush_now.wait(), TELEGRAM_BATCH_INTERVAL)
+            self._flush_now.clear()
+            batch = self._take_batch(first)
+            try:
+                results = await self._send_batch([message for message, _ in batch])
+            except asyncio.CancelledError:
+                # Очередь остановлена: отправители не должны ждать результата бесконечно
+                for _, future in batch:
+                    if future is not None and not future.done():
+                        future.cancel()
+                raise
+            except Exception as e:
+                # Непредвиденная ошибка передаётся отправителям сообщений, очередь продолжает работу
+                logging.error(f"Ошибка очереди отправки в Telegram: {type(e).__name__}: {e}")
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future is not None and not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                self._queue.task_done()
+    
+    async def _send_batch(self, messages: List[str]) -> List[bool]:
+        """
+        Отправка пачки сообщений одним запросом. Если Telegram отклоняет объединённое сообщение
+        (BadRequest, например из-за разметки), сообщения отправляются по одному: ошибка в одном
+        не должна терять остальные.
+        """
+        await self._global_bucket.acquire()
+        await self._chat_bucket.acquire()
+        if len(messages) == 1:
+            return [await self._send_chunk(messages[0])]
+        try:
+            result = await self._send_chunk(TELEGRAM_BATCH_SEPARATOR.join(messages), raise_bad_request=True)
+            return [result] * len(messages)
+        except BadRequest as e:
+            logging.warning(f"Telegram отклонил объединённое сообщение ({e}), {len(messages)} сообщений отправляются по одному.")
+        results = []
+        for message in messages:
+            await self._global_bucket.acquire()
+            await self._chat_bucket.acquire()
+            results.append(await self._send_chunk(message))
+        return results
+    
+    async def _send_chunk(self, message: str, raise_bad_request: bool = False) -> bool:
+        """
+        Отправка одной части сообщения в Telegram чат.
+        raise_bad_request - передать BadRequest вызывающему вместо записи в лог.
+        """
         try:
-            logging.debug(f"Попытка отправки сообщения в Telegram... (длина: {len(message)} символов)")
+            logging.debug("Попытка отправки сообщения в Telegram... (длина: %d символов)", len(message))
             bot = await self._get_bot()
             await bot.send_message(
                 chat_id=self._chat_id,
@@ -149,337 +500,1047 @@ class TelegramNotifier:
             logging.info("Сообщение успешно отправлено в Telegram.")
             return True
         except asyncio.CancelledError:
-            # Если задача была отменена, пытаемся отправить синхронно
+            # Задача отменена: сообщение отправляется синхронно в отдельном потоке,
+            # чтобы не блокировать цикл событий, после чего отмена передаётся дальше
             logging.warning("Асинхронная операция была прервана, попытка синхронной отправки...")
-            try:
-                import requests
-                token = self._bot_token
-                chat_id = self._chat_id
-                url = f"https://api.telegram.org/bot{token}/sendMessage"
-                payload = {
-                    "chat_id": chat_id,
-                    "text": message,
-                    "parse_mode": "HTML"
-                }
-                response = requests.post(url, json=payload, timeout=5)
-                if response.status_code == 200:
-                    logging.info("Сообщение отправлено синхронно (запасной вариант).")
-                    return True
-                else:
-                    logging.error(f"Ошибка синхронной отправки: HTTP {response.status_code}")
-                    return False
-            except Exception as sync_error:
-                logging.error(f"Синхронная отправка также не удалась: {sync_error}")
-                return False
-        except Exception as e:
+            await asyncio.to_thread(self._send_sync, message)
+            raise
+        except TelegramError as e:
+            if raise_bad_request and isinstance(e, BadRequest):
+                raise
             logging.error(f"Ошибка отправки сообщения в Telegram: {type(e).__name__}: {e}")
             return False
         
-    async def notify_new_ports(self, ip: str, new_ports: list[int], services: dict):
-        """ Отправка уведомления о новых открытых портах. """
+    def _send_sync(self, message: str) -> bool:
+        """Запасная синхронная отправка сообщения через HTTP API Telegram."""
+        try:
+            url = f"https://api.telegram.org/bot{self._bot_token}/sendMessage"
+            payload = {
+                "chat_id": self._chat_id,
+                "text": message,
+                "parse_mode": "HTML"
+            }
+            response = self._sync_session.post(url, json=payload, timeout=5)
+            if response.status_code == 200:
+                logging.info("Сообщение отправлено синхронно (запасной вариант).")
+                return True
+            else:
+                logging.error(f"Ошибка синхронной отправки: HTTP {response.status_code}")
+                return False
+        except requests.RequestException as sync_error:
+            logging.error(f"Синхронная отправка также не удалась: {sync_error}")
+            return False
+        
+    def _format_new_ports(self, ip: str, new_ports: list[int], services: dict, now: str) -> str:
+        """Текст уведомления о новых открытых портах."""
+        parts = [self._NEW_PORTS_HEADER.format(ip=ip, ts=now, count=len(new_ports))]
+        # Сборка через join: без копирования всего сообщения на каждый порт
+        line = self._NEW_PORT_LINE.format
+        parts.extend(
+            line(port=port, service=html.escape(services.get(str(port), 'Неизвестно')))
+            for port in new_ports
+        )
+        return "".join(parts)
+    
+    @staticmethod
+    def _format_changed_services(ip: str, changed_ports: dict, now: str) -> str:
+        """Текст уведомления об изменении сервисов на портах."""
+        parts = [
+            "<b>Изменение сервисов на портах!</b>\n\n"
+            f"<b>IP:</b> {ip}\n"
+            f"<b>Время:</b> {now}\n\n"
+            f"<b>Измененные порты ({len(changed_ports)}):</b>\n"
+        ]
+        parts.extend(
+            f" - Порт {port}/tcp:\n   Было: {html.escape(old_service)}\n   Стало: {html.escape(new_service)}\n"
+            for port, (old_service, new_service) in changed_ports.items()
+        )
+        return "".join(parts)
+    
+    async def notify_new_ports(self, ip: str, new_ports: list[int], services: dict, scan_ts: str = None):
+        """ Отправка уведомления о новых открытых портах. scan_ts - общее время обработки сканирования. """
         if not new_ports:
             return
         
-        message = f"<b>Обнаружены новые открытые порты!</b>\n\n"
-        message += f"<b>IP:</b> {ip}\n"
-        message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        message += f"<b>Новые порты ({len(new_ports)}):</b>\n"
-        
-        for port in new_ports:
-            service = services.get(str(port), "Неизвестно")
-            message += f" - Порт {port}/tcp: {service}\n"
-            
-        await self.send_message(message)
+        now = scan_ts or _now_str()
+        await self.send_message(self._format_new_ports(ip, new_ports, services, now))
     
-    async def notify_changed_services(self, ip: str, changed_ports: dict):
-        """Отправка уведомления об изменении сервисов на портах."""
+    async def notify_changed_services(self, ip: str, changed_ports: dict, scan_ts: str = None):
+        """Отправка уведомления об изменении сервисов на портах. scan_ts - общее время обработки сканирования."""
         if not changed_ports:
             return
         
-        message = f"<b>Изменение сервисов на портах!</b>\n\n"
-        message += f"<b>IP:</b> {ip}\n"
-        message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        message += f"<b>Измененные порты ({len(changed_ports)}):</b>\n"
+        now = scan_ts or _now_str()
+        await self.send_message(self._format_changed_services(ip, changed_ports, now))
+    
+    async def notify_ip_changes(self, ip: str, new_ports: list[int], changed_ports: dict, services: dict,
+                                scan_ts: str = None):
+        """
+        Одно уведомление обо всех изменениях IP за сканирование: новые порты и изменённые сервисы
+        отправляются общим сообщением, а не двумя отдельными.
+        """
+        if not new_ports and not changed_ports:
+            return
         
-        for port, (old_service, new_service) in changed_ports.items():
-            message += f" - Порт {port}/tcp:\n"
-            message += f"   Было: {old_service}\n"
-            message += f"   Стало: {new_service}\n"
-            
-        await self.send_message(message)
+        now = scan_ts or _now_str()
+        parts = []
+        if new_ports:
+            parts.append(self._format_new_ports(ip, new_ports, services, now))
+        if changed_ports:
+            parts.append(self._format_changed_services(ip, changed_ports, now))
+        # Без ожидания отправки: обработка IP не задерживается на окно объединения сообщений
+        await self.send_message("\n".join(parts), wait=False)
     
     async def notify_scan_results_single(self, target_name: str, target: str, ports_info: dict):
         """Отправка полной информации о результатах разового сканирования."""
+        now = _now_str()
         if not ports_info:
-            message = f"<b>Сканирование завершено!</b>\n\n"
-            message += f"<b>Цель:</b> {target_name}\n"
-            message += f"<b>Адрес:</b> {target}\n"
-            message += f"<b>Результат:</b> Открытых портов не обнаружено\n"
-            message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            message = (
+                "<b>Сканирование завершено!</b>\n\n"
+                f"<b>Цель:</b> {html.escape(target_name)}\n"
+                f"<b>Адрес:</b> {html.escape(target)}\n"
+                "<b>Результат:</b> Открытых портов не обнаружено\n"
+                f"<b>Время:</b> {now}\n"
+            )
             
             await self.send_message(message)
             return
         
-        message = f"<b>Результаты сканирования:</b>\n\n"
-        message += f"<b>Цель:</b> {target_name}\n"
-        message += f"<b>Адрес:</b> {target}\n"
-        message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        message += f"<b>Открытые порты ({len(ports_info)}):</b>\n"
-        
-        for port, service in ports_info.items():
-            message += f" - Порт {port}/tcp: {service}\n"
+        parts = [
+            "<b>Результаты сканирования:</b>\n\n"
+            f"<b>Цель:</b> {html.escape(target_name)}\n"
+            f"<b>Адрес:</b> {html.escape(target)}\n"
+            f"<b>Время:</b> {now}\n\n"
+            f"<b>Открытые порты ({len(ports_info)}):</b>\n"
+        ]
+        parts.extend(f" - Порт {port}/tcp: {html.escape(service)}\n" for port, service in ports_info.items())
             
-        await self.send_message(message)
+        await self.send_message("".join(parts))
     
     async def notify_schedule_started(self, target_name: str, target: str, ports: str, interval_hours: float):
         """Уведомление о начале планового сканирования одной цели."""
-        message = f"<b>Начало планового сканирования!</b>\n\n"
-        message += f"<b>Цель:</b> {target_name}\n"
-        message += f"<b>Адрес:</b> {target}\n"
-        message += f"<b>Порты:</b> {ports}\n"
-        message += f"<b>Интервал:</b> каждые {interval_hours} часов\n"
-        message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        message = (
+            "<b>Начало планового сканирования!</b>\n\n"
+            f"<b>Цель:</b> {html.escape(target_name)}\n"
+            f"<b>Адрес:</b> {html.escape(target)}\n"
+            f"<b>Порты:</b> {html.escape(ports)}\n"
+            f"<b>Интервал:</b> каждые {interval_hours} часов\n"
+            f"<b>Время:</b> {_now_str()}\n"
+        )
         
         await self.send_message(message)
     
     async def notify_schedule_started_multiple(self, targets: List[Dict[str, Any]], interval_hours: float):
         """Уведомление о начале планового сканирования нескольких целей."""
-        message = f"<b>Начало планового сканирования!</b>\n\n"
-        message += f"<b>Количество целей:</b> {len(targets)}\n"
-        message += f"<b>Интервал:</b> каждые {interval_hours} часов\n\n"
-        message += f"<b>Цели для сканирования:</b>\n"
-        
-        for idx, target in enumerate(targets, 1):
-            target_name = target.get("name", "Unknown")
-            target_addr = target.get("target", "Unknown")
-            target_ports = target.get("ports", "Unknown")
-            message += f"\n{idx}. {target_name}\n"
-            message += f"   Адрес: {target_addr}\n"
-            message += f"   Порты: {target_ports}\n"
-        
-        message += f"\n<b>Время начала:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-        
-        await self.send_message(message)
+        parts = [
+            "<b>Начало планового сканирования!</b>\n\n"
+            f"<b>Количество целей:</b> {len(targets)}\n"
+            f"<b>Интервал:</b> каждые {interval_hours} часов\n\n"
+            "<b>Цели для сканирования:</b>\n"
+        ]
+        parts.extend(
+            f"\n{idx}. {html.escape(target.get('name', 'Unknown'))}\n"
+            f"   Адрес: {html.escape(target.get('target', 'Unknown'))}\n"
+            f"   Порты: {html.escape(target.get('ports', 'Unknown'))}\n"
+            for idx, target in enumerate(targets, 1)
+        )
+        parts.append(f"\n<b>Время начала:</b> {_now_str()}\n")
+        
+        await self.send_message("".join(parts))
     
     async def notify_schedule_stopped(self, scan_count: int, total_cycles: int) -> bool:
         """Уведомление о завершении планового сканирования."""
-        message = f"<b>Плановое сканирование остановлено!</b>\n\n"
-        message += f"<b>Завершено циклов:</b> {total_cycles}\n"
-        message += f"<b>Проведено проверок портов:</b> {scan_count}\n"
-        message += f"<b>Время остановки:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        message = (
+            "<b>Плановое сканирование остановлено!</b>\n\n"
+            f"<b>Завершено циклов:</b> {total_cycles}\n"
+            f"<b>Проведено проверок портов:</b> {scan_count}\n"
+            f"<b>Время остановки:</b> {_now_str()}\n"
+        )
         
-        return await self.send_message(message)
+        # Финальное сообщение отправляется сразу вместе со всеми ещё не отправленными
+        return await self.send_message(message, flush=True)
         
     async def notify_scan_complete(self, target_name: str, total_ports: int):
         """Отправка уведомления об окончании сканирования."""
         
-        message = f"<b>Сканирование завершено!</b>\n\n"
-        message += f"<b>Цель:</b> {target_name}\n"
-        message += f"<b>Всего открытых портов:</b> {total_ports}\n"
-        message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        message = self._SCAN_COMPLETE.format(
+            target_name=html.escape(target_name),
+            total_ports=total_ports,
+            ts=_now_str()
+        )
         
         await self.send_message(message)
         
     async def notify_scan_start(self, target_name: str, target: str, ports: str):
         """Отправка уведомления о начале сканирования."""
         
-        message = f"<b>Начало сканирования!</b>\n\n"
-        message += f"<b>Цель:</b> {target_name}\n"
-        message += f"<b>Адрес:</b> {target}\n"
-        message += f"<b>Порты:</b> {ports}\n"
-        message += f"<b>Время:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+        message = (
+            "<b>Начало сканирования!</b>\n\n"
+            f"<b>Цель:</b> {html.escape(target_name)}\n"
+            f"<b>Адрес:</b> {html.escape(target)}\n"
+            f"<b>Порты:</b> {html.escape(ports)}\n"
+            f"<b>Время:</b> {_now_str()}\n"
+        )
         
-        await self.send_message(message)
+        # Без ожидания отправки: masscan запускается, не дожидаясь окна объединения сообщений
+        await self.send_message(message, wait=False)
 
 
 # === 4. Banner Grabber Class ===
+# Сервисы на стандартных портах (имена как в nmap-services): для них nmap не запускается
+_WELL_KNOWN_PORTS: Dict[int, str] = {
+    21: 'ftp',
+    22: 'ssh',
+    23: 'telnet',
+    25: 'smtp',
+    53: 'domain',
+    80: 'http',
+    110: 'pop3',
+    143: 'imap',
+    443: 'https',
+    445: 'microsoft-ds',
+    993: 'imaps',
+    995: 'pop3s',
+    3306: 'mysql',
+    3389: 'ms-wbt-server',
+    5432: 'postgresql',
+    6379: 'redis',
+    8080: 'http-proxy',
+    8443: 'https-alt',
+}
+
+# Сколько хостов передаётся в один запуск nmap (совпадает с --max-hostgroup в аргументах по умолчанию)
+_NMAP_HOSTGROUP = 256
+
+# Сколько секунд ждать завершения nmap после SIGTERM, прежде чем послать SIGKILL
+_NMAP_TERMINATE_TIMEOUT = 5
+
+# После стольких подряд одинаковых баннеров порт считается стабильным и берётся из кэша дольше (stable_ttl)
+_BANNER_STABLE_SCANS = 3
+
+# Раз во сколько циклов планового сканирования заново опрашиваются порты (из кэша берутся остальные циклы)
+_BANNER_RECHECK_CYCLES = 2
+
+# Раз во сколько циклов планового сканирования заново опрашиваются стабильные порты
+_BANNER_STABLE_RECHECK_CYCLES = 6
+
+# Через сколько секунд без новых портов IP его накопленные порты передаются на получение баннеров,
+# не дожидаясь окончания masscan
+_BANNER_DEBOUNCE = 2.0
+
+# Источник строки сервиса: баннер порта либо запасной вариант (таблица стандартных портов, Nmap).
+# Строки разных источников не сравниваются: "HTTP/1.1 nginx" и "http" - не смена сервиса
+_SOURCE_BANNER = "banner"
+_SOURCE_FALLBACK = "fallback"
+
+# Результаты неудачного определения сервиса не делают порт стабильным
+_UNRESOLVED_SERVICES = frozenset({
+    "Порт не сканирован", "Ошибка сканирования (Nmap)", "Ошибка при сканировании", "Нет ответа"
+})
+# Префикс результата Nmap для порта, который он не увидел открытым ("Закрыт (filtered)" и т.п.)
+_CLOSED_SERVICE_PREFIX = "Закрыт ("
+
+
+def _is_unresolved_service(service: str) -> bool:
+    """Сервис не определён: ошибка Nmap, хост не ответил или порт не открыт по данным Nmap."""
+    return service in _UNRESOLVED_SERVICES or service.startswith(_CLOSED_SERVICE_PREFIX)
+
+
 class BannerGrabber:
-    """Получение баннеров с открытых портов при помощи nmap."""
+    """
+    Получение баннеров с открытых портов.
+    Баннер читается прямым TCP-подключением, nmap (-sV) используется
+    только для портов, которые не вернули баннер.
+    """
     
-    def __init__(self, nmap_args: List[str] = None):
-        self.nm = nmap.PortScanner()
+    # Запрос-«подсказка» для сервисов, которые молчат до запроса клиента (HTTP)
+    HTTP_PROBE = b"HEAD / HTTP/1.0\r\n\r\n"
+    
+    def __init__(self, nmap_args: List[str] = None, connect_timeout: float = 2.0, read_timeout: float = 2.0,
+                 concurrency: int = 64, cache_ttl: float = 0, nmap_concurrency: int = 20, stable_ttl: float = 0):
+        self.nmap_path = self._check_nmap_installed()
         self.nmap_args = nmap_args or ['-sV', '--version-intensity=1', '-T5', '--open', '-n', '-Pn', '--max-hostgroup=256']
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Ограничение числа одновременных TCP-подключений при опросе многих портов
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Ограничение числа одновременно запущенных процессов nmap
+        self._nmap_semaphore = asyncio.Semaphore(nmap_concurrency)
+        # Кэш баннеров (ip, port) -> (время получения, сервис); cache_ttl = 0 отключает кэш.
+        # Время хранится как time.time(), чтобы кэш можно было сохранить в историю между запусками
+        self.cache_ttl = cache_ttl
+        self._banner_cache: Dict[Tuple[str, int], Tuple[float, str]] = {}
+        # Срок кэша для стабильных портов и счётчики подряд одинаковых баннеров: (ip, port) -> (сервис, число)
+        self.stable_ttl = max(stable_ttl, cache_ttl)
+        self._stable: Dict[Tuple[str, int], Tuple[str, int]] = {}
+        # Порты, сервис которых получен из баннера, а не из таблицы стандартных портов или Nmap
+        self._banner_keys: set = set()
+        
+    @staticmethod
+    def _check_nmap_installed() -> str:
+        """Проверка установки nmap в системе."""
+        nmap_path = shutil.which('nmap')
+        if not nmap_path:
+            logging.error("Ошибка при проверке наличия nmap: nmap не найден в PATH.")
+            sys.exit(1)
+        return nmap_path
+        
+    @staticmethod
+    def _format_banner(service: dict) -> str:
+        """Формирование строки сервиса из атрибутов элемента <service> вывода Nmap."""
+        service_name = service.get('name', 'Unknown')
+        product = service.get('product', '').strip()
+        version = service.get('version', '').strip()
+        extrainfo = service.get('extrainfo', '').strip()
+        
+        # Формируем полное описание сервиса
+        banner_parts = [service_name]
+        if product:
+            banner_parts.append(product)
+        if version:
+            banner_parts.append(version)
+        if extrainfo:
+            banner_parts.append(f"({extrainfo})")
+        
+        return " ".join(banner_parts).strip()
+    
+    async def _scan_hosts(self, ports_by_ip: Dict[str, List[int]]) -> Dict[str, Dict[int, str]]:
+        """
+        Один запуск Nmap для группы хостов: сканируется объединение их портов,
+        в результат каждого хоста попадают только его порты.
+        XML-вывод (-oX -) читается из pipe и разбирается потоково, по мере поступления.
+        """
+        all_ports = sorted(set().union(*ports_by_ip.values()))
+        ports_str = ','.join(map(str, all_ports))
+        
+        logging.debug("Сканирование %d портов на %d хостах за одну операцию: %s", len(all_ports), len(ports_by_ip), ports_str)
         
-    def identify_open_ports(self, ip: str, ports: List[int]) -> Dict[int, str]:
-        """Получение баннеров для всех портов сразу."""
+        cmd = [
+            self.nmap_path, *self.nmap_args,
+            f'--min-hostgroup={len(ports_by_ip)}',
+            '-oX', '-', '-p', ports_str, *ports_by_ip
+        ]
+        # close_fds=False и абсолютный путь позволяют subprocess запускать nmap через posix_spawn вместо fork
+        # (дескрипторы Python и так не наследуются, PEP 446)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            close_fds=False
+        )
+        # stderr читается параллельно, чтобы переполненный pipe не остановил nmap
+        stderr_task = asyncio.create_task(proc.stderr.read())
+        
+        parser = ET.XMLPullParser(events=('end',))
+        services_by_ip = {ip: {port: "Порт не сканирован" for port in ports} for ip, ports in ports_by_ip.items()}
+        found_hosts = set()
+        
+        try:
+            while chunk := await proc.stdout.read(65536):
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    # Хост разбирается целиком по закрытию <host>, затем его поддерево освобождается
+                    if elem.tag != 'host':
+                        continue
+                    
+                    address = next((addr.get('addr') for addr in elem.iterfind('address') if addr.get('addrtype') != 'mac'), None)
+                    services = services_by_ip.get(address)
+                    if services is not None:
+                        found_hosts.add(address)
+                        for port_elem in elem.iterfind('ports/port'):
+                            port = int(port_elem.get('portid', 0))
+                            if port not in services:
+                                continue
+                            # Проверяем статус открытости портов
+                            state = port_elem.find('state')
+                            port_status = state.get('state', 'unknown') if state is not None else 'unknown'
+                            if port_status != 'open':
+                                services[port] = f"{_CLOSED_SERVICE_PREFIX}{port_status})"
+                            else:
+                                service = port_elem.find('service')
+                                services[port] = self._format_banner(service.attrib if service is not None else {})
+                    elem.clear()
+            returncode = await proc.wait()
+        finally:
+            # Прерванный разбор (отмена, ошибка XML) не должен оставлять nmap работать:
+            # иначе отмена ждёт его завершения, а заполненный pipe stdout останавливает nmap навсегда
+            if proc.returncode is None:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), _NMAP_TERMINATE_TIMEOUT)
+                except TimeoutError:
+                    with contextlib.suppress(ProcessLookupError):
+                        proc.kill()
+            stderr = await stderr_task
+        
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr.decode('utf-8', errors='replace'))
+        
+        for ip, ports in ports_by_ip.items():
+            if ip not in found_hosts:
+                logging.warning(f"Нет данных от Nmap для {ip}")
+                services_by_ip[ip] = {port: "Нет ответа" for port in ports}
+        
+        return services_by_ip
+        
+    async def _identify_with_nmap(self, ip: str, ports: List[int]) -> Dict[int, str]:
+        """
+        Получение баннеров для всех портов хоста одним запуском Nmap.
+        При ошибке пакетного запуска порты сканируются по одному,
+        чтобы сбой на одном порту не терял результаты остальных.
+        """
         if not ports:
             return {}
         
         try:
-            ports_str = ','.join(map(str, ports))
-            
-            logging.debug(f"Сканирование {len(ports)} портов на {ip} за одну операцию: {ports_str}")
+            async with self._nmap_semaphore:
+                return (await self._scan_hosts({ip: ports}))[ip]
+        except (subprocess.CalledProcessError, ET.ParseError) as e:
+            # Обработка ошибок сканирования Nmap
+            stderr = getattr(e, 'stderr', '') or ''
+            logging.warning(f"Ошибка сканирования Nmap для {ip} (порты: {ports}): {e} {stderr.strip()}")
+            if len(ports) == 1:
+                return {port: "Ошибка сканирования (Nmap)" for port in ports}
+        except OSError as e:
+            logging.warning(f"Не удалось запустить Nmap для {ip}: {type(e).__name__}: {e}")
+            if len(ports) == 1:
+                return {port: "Ошибка при сканировании" for port in ports}
+        
+        # Запасной путь: изоляция ошибок по отдельным портам
+        logging.info(f"Повторное сканирование {len(ports)} портов на {ip} по одному.")
+        services = {}
+        for port in ports:
+            services.update(await self._identify_with_nmap(ip, [port]))
+        return services
+    
+    async def _identify_hosts_with_nmap(self, ports_by_ip: Dict[str, List[int]]) -> Dict[str, Dict[int, str]]:
+        """
+        Получение баннеров для группы хостов одним запуском Nmap.
+        При ошибке пакетного запуска хосты сканируются по отдельности (см. _identify_with_nmap).
+        """
+        if len(ports_by_ip) == 1:
+            ip, ports = next(iter(ports_by_ip.items()))
+            return {ip: await self._identify_with_nmap(ip, ports)}
+        
+        try:
+            async with self._nmap_semaphore:
+                return await self._scan_hosts(ports_by_ip)
+        except (subprocess.CalledProcessError, ET.ParseError) as e:
+            stderr = getattr(e, 'stderr', '') or ''
+            logging.warning(f"Ошибка сканирования Nmap для {len(ports_by_ip)} хостов: {e} {stderr.strip()}")
+        except OSError as e:
+            logging.warning(f"Не удалось запустить Nmap для {len(ports_by_ip)} хостов: {type(e).__name__}: {e}")
+        
+        # Запасной путь: изоляция ошибок по отдельным хостам
+        logging.info(f"Повторное сканирование {len(ports_by_ip)} хостов по одному.")
+        services_list = await asyncio.gather(*(self._identify_with_nmap(ip, ports) for ip, ports in ports_by_ip.items()))
+        return dict(zip(ports_by_ip, services_list))
+    
+    @staticmethod
+    def _normalize_banner(data: bytes) -> str:
+        """
+        Первая непустая строка ответа сервиса (без даты и прочих изменчивых заголовков).
+        Для HTTP - версия протокола и заголовок Server ("HTTP/1.1 nginx/1.24.0") без кода ответа:
+        смена 200 на 503 или 301 на 302 не является сменой сервиса.
+        Бинарный ответ (например, TLS alert на HTTP-запрос) считается нераспознанным.
+        """
+        lines = [line.strip() for line in data.decode('utf-8', errors='replace').splitlines()]
+        first = next((line for line in lines if line), "")
+        if not first.isprintable():
+            return ""
+        if first.startswith("HTTP/"):
+            server = next((line.split(":", 1)[1].strip() for line in lines if line.lower().startswith("server:")), "")
+            protocol = first.split(None, 1)[0]
+            return f"{protocol} {server}" if server and server.isprintable() else protocol
+        return first
+    
+    async def grab(self, ip: str, port: int) -> str:
+        """Чтение баннера с порта через TCP-подключение. Пустая строка - баннер не получен."""
+        writer = None
+        async with self._semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip, port),
+                    self.connect_timeout
+                )
+                writer.write(self.HTTP_PROBE)
+                await writer.drain()
+                data = await asyncio.wait_for(reader.read(1024), self.read_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.debug("Баннер с %s:%d не получен: %s: %s", ip, port, type(e).__name__, e)
+                return ""
+            finally:
+                if writer is not None:
+                    writer.close()
+                    try:
+                        await writer.wait_closed()
+                    except OSError:
+                        pass
+        
+        return self._normalize_banner(data)
+    
+    async def identify_open_ports(self, ip: str, ports: List[int]) -> Dict[int, str]:
+        """Получение баннеров для всех портов одного хоста (см. identify_open_ports_multi)."""
+        if not ports:
+            return {}
+        return (await self.identify_open_ports_multi({ip: ports}))[ip]
+    
+    async def identify_open_ports_multi(self, ports_by_ip: Dict[str, List[int]]) -> Dict[str, Dict[int, str]]:
+        """
+        Получение баннеров для всех портов нескольких хостов.
+        Все порты опрашиваются одновременно. Порт без баннера определяется
+        по таблице стандартных портов, для остальных nmap запускается
+        один раз на группу до _NMAP_HOSTGROUP хостов, а не на каждый хост.
+        """
+        now = time.time()
+        services_by_ip: Dict[str, Dict[int, str]] = {ip: {} for ip in ports_by_ip}
+        fresh_pairs = []
+        for ip, ports in ports_by_ip.items():
+            services = services_by_ip[ip]
+            if self.cache_ttl > 0:
+                for port in ports:
+                    cached = self._banner_cache.get((ip, port))
+                    if cached and now - cached[0] < self._entry_ttl((ip, port)):
+                        services[port] = cached[1]
             
-            scan_nmap_result = self.nm.scan(
-                hosts=ip,
-                ports=ports_str,
-                arguments=' '.join(self.nmap_args)
-            )
+            fresh_ports = [port for port in ports if port not in services]
+            if fresh_ports:
+                fresh_pairs.extend((ip, port) for port in fresh_ports)
+            elif ports:
+                logging.debug("Баннеры всех %d портов на %s взяты из кэша.", len(ports), ip)
+        
+        banners = await asyncio.gather(*[self.grab(ip, port) for ip, port in fresh_pairs])
+        missing_by_ip: Dict[str, List[int]] = defaultdict(list)
+        for (ip, port), banner in zip(fresh_pairs, banners):
+            if banner:
+                services_by_ip[ip][port] = banner
+            elif port in _WELL_KNOWN_PORTS:
+                services_by_ip[ip][port] = _WELL_KNOWN_PORTS[port]
+            else:
+                missing_by_ip[ip].append(port)
+        
+        if missing_by_ip:
+            logging.debug("Баннер не получен для портов на %d хостах, запуск Nmap.", len(missing_by_ip))
+            ips = list(missing_by_ip)
+            groups = [
+                {ip: missing_by_ip[ip] for ip in ips[i:i + _NMAP_HOSTGROUP]}
+                for i in range(0, len(ips), _NMAP_HOSTGROUP)
+            ]
+            for group_services in await asyncio.gather(*(self._identify_hosts_with_nmap(group) for group in groups)):
+                for ip, services in group_services.items():
+                    services_by_ip[ip].update(services)
+        
+        for (ip, port), banner in zip(fresh_pairs, banners):
+            if banner:
+                self._banner_keys.add((ip, port))
+            else:
+                self._banner_keys.discard((ip, port))
+        
+        if self.cache_ttl > 0:
+            for ip, port in fresh_pairs:
+                service = services_by_ip[ip][port]
+                self._banner_cache[(ip, port)] = (now, service)
+                self._update_stability((ip, port), service)
+        
+        return {ip: {port: services_by_ip[ip][port] for port in ports} for ip, ports in ports_by_ip.items()}
+    
+    def _entry_ttl(self, key: Tuple[str, int]) -> float:
+        """Срок хранения баннера в кэше: для стабильного порта - stable_ttl, иначе cache_ttl."""
+        stable = self._stable.get(key)
+        if stable is not None and stable[1] >= _BANNER_STABLE_SCANS:
+            return self.stable_ttl
+        return self.cache_ttl
+    
+    def _update_stability(self, key: Tuple[str, int], service: str):
+        """Подсчёт подряд одинаковых баннеров порта; другой баннер сбрасывает счётчик."""
+        if _is_unresolved_service(service):
+            self._stable.pop(key, None)
+            return
+        previous = self._stable.get(key)
+        count = previous[1] + 1 if previous is not None and previous[0] == service else 1
+        self._stable[key] = (service, count)
+        if count == _BANNER_STABLE_SCANS:
+            logging.debug("Баннер %s:%s не менялся %d сканирований подряд, порт считается стабильным.",
+                          key[0], key[1], count)
+    
+    def _evict_expired(self):
+        """Удаление из кэша баннеров устаревших записей."""
+        now = time.time()
+        expired = [key for key, (ts, _) in self._banner_cache.items() if now - ts >= self._entry_ttl(key)]
+        for key in expired:
+            del self._banner_cache[key]
+    
+    def _evict_closed(self, ports_by_ip: Dict[str, List[int]]):
+        """
+        Удаление из кэша портов, которых нет в результате masscan для просканированных IP:
+        закрывшийся и снова открытый порт должен быть опрошен заново.
+        """
+        open_ports = {(ip, port) for ip, ports in ports_by_ip.items() for port in ports}
+        closed = [key for key in self._banner_cache if key[0] in ports_by_ip and key not in open_ports]
+        for key in closed:
+            del self._banner_cache[key]
+        for key in [key for key in self._stable if key[0] in ports_by_ip and key not in open_ports]:
+            del self._stable[key]
+        self._banner_keys = {key for key in self._banner_keys if key[0] not in ports_by_ip or key in open_ports}
+    
+    def load_cache(self, entries: Dict[Tuple[str, int], Tuple[float, str]], banner_keys: set = frozenset()):
+        """
+        Заполнение кэша баннеров сохранёнными в истории значениями (после перезапуска).
+        banner_keys - порты, сервис которых в истории получен из баннера.
+        """
+        if self.cache_ttl <= 0:
+            return
+        now = time.time()
+        for key, (ts, service) in entries.items():
+            if now - ts < self.cache_ttl:
+                self._banner_cache[key] = (ts, service)
+                if key in banner_keys:
+                    self._banner_keys.add(key)
+        if self._banner_cache:
+            logging.info(f"Из истории загружено {len(self._banner_cache)} кэшированных баннеров.")
+    
+    def service_sources(self, ip: str, ports: List[int]) -> Dict[str, str]:
+        """Источник сервиса портов IP для истории: _SOURCE_BANNER или _SOURCE_FALLBACK."""
+        return {
+            str(port): _SOURCE_BANNER if (ip, port) in self._banner_keys else _SOURCE_FALLBACK
+            for port in ports
+        }
+    
+    def cache_timestamps(self, ip: str, ports: List[int]) -> Dict[int, float]:
+        """Время получения закэшированных баннеров портов IP (для сохранения в историю)."""
+        return {port: self._banner_cache[(ip, port)][0] for port in ports if (ip, port) in self._banner_cache}
+    
+    async def grab_all(self, ports_by_ip: Dict[str, List[int]]) -> Dict[str, Dict[int, str]]:
+        """Получение баннеров сразу для всех IP и портов результата сканирования."""
+        if self._banner_cache:
+            self._evict_expired()
+            self._evict_closed(ports_by_ip)
+        return await self.identify_open_ports_multi(ports_by_ip)
+    
+    def stream(self, debounce: float = _BANNER_DEBOUNCE) -> "_BannerStream":
+        """Получение баннеров по мере поступления результатов masscan (см. _BannerStream)."""
+        if self._banner_cache:
+            self._evict_expired()
+        return _BannerStream(self, debounce)
 
-            # Извлечение данных о сервисах
-            host_data = scan_nmap_result.get('scan', {}).get(ip, {})
-            if not host_data:
-                logging.warning(f"Нет данных от Nmap для {ip}")
-                return {port: "Нет ответа" for port in ports}
-            
-            tcp_info = host_data.get('tcp', {})
-            services = {}
-            
-            # Обработка каждого порта из результатов
-            for port in ports:
-                port_info = tcp_info.get(port, {})
-                
-                if not port_info:
-                    services[port] = "Порт не сканирован"
-                    continue
-                
-                # Проверяем статус открытости портов
-                port_status = port_info.get('state', 'unknown')
-                if port_status != 'open':
-                    services[port] = f"Закрыт ({port_status})"
-                    continue
-                
-                service_name = port_info.get('name', 'Unknown')
-                product = port_info.get('product', '').strip()
-                version = port_info.get('version', '').strip()
-                extrainfo = port_info.get('extrainfo', '').strip()
-                
-                # Формируем полное описание сервиса
-                banner_parts = [service_name]
-                if product:
-                    banner_parts.append(product)
-                if version:
-                    banner_parts.append(version)
-                if extrainfo:
-                    banner_parts.append(f"({extrainfo})")
-                
-                services[port] = " ".join(banner_parts).strip()
-            
-            return services
 
-        except nmap.PortScannerError as e:
-            # Обработка ошибок сканирования Nmap
-            logging.warning(f"Ошибка сканирования Nmap для {ip} (порты: {ports}): {e}")
-            return {port: "Ошибка сканирования (Nmap)" for port in ports}
-        except Exception as e:
-            logging.debug(f"Общая ошибка при получении информации о портах на {ip}: {type(e).__name__}: {e}")
-            return {port: "Ошибка при сканировании" for port in ports}
+class _BannerStream:
+    """
+    Получение баннеров параллельно с работой masscan.
+    Открытые порты накапливаются по IP; если для IP debounce секунд не было новых портов,
+    накопленные порты передаются BannerGrabber, не дожидаясь окончания сканирования.
+    Порты остальных IP опрашиваются в finish() после завершения masscan.
+    """
+    
+    def __init__(self, grabber: BannerGrabber, debounce: float):
+        self._grabber = grabber
+        self._debounce = debounce
+        self._loop = asyncio.get_running_loop()
+        # Порты, ещё не переданные на получение баннеров, и все уже полученные от masscan
+        self._pending: Dict[str, List[int]] = defaultdict(list)
+        self._seen: Dict[str, set] = defaultdict(set)
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        # IP, у которых истёк таймер; передаются одной пачкой в _dispatch
+        self._ready: List[str] = []
+        self._tasks: List[asyncio.Task] = []
+        self._services_by_ip: Dict[str, Dict[int, str]] = defaultdict(dict)
+    
+    def add(self, record: "PortRecord"):
+        """Приём одного результата masscan: таймер IP откладывается на debounce секунд."""
+        seen = self._seen[record.ip]
+        if record.port in seen:
+            return
+        seen.add(record.port)
+        self._pending[record.ip].append(record.port)
+        
+        timer = self._timers.get(record.ip)
+        if timer is not None:
+            timer.cancel()
+        self._timers[record.ip] = self._loop.call_later(self._debounce, self._flush_ip, record.ip)
+    
+    def _flush_ip(self, ip: str):
+        """Истёк таймер IP: IP, готовые в одной итерации цикла событий, опрашиваются вместе."""
+        del self._timers[ip]
+        if not self._ready:
+            self._loop.call_soon(self._dispatch)
+        self._ready.append(ip)
+    
+    def _dispatch(self):
+        batch = {ip: self._pending.pop(ip) for ip in self._ready if ip in self._pending}
+        self._ready.clear()
+        if batch:
+            logging.debug("Получение баннеров для %d IP до окончания masscan.", len(batch))
+            self._tasks.append(asyncio.create_task(self._grab(batch)))
+    
+    async def _grab(self, ports_by_ip: Dict[str, List[int]]):
+        for ip, services in (await self._grabber.identify_open_ports_multi(ports_by_ip)).items():
+            self._services_by_ip[ip].update(services)
+    
+    async def finish(self, ports_by_ip: Dict[str, List[int]]) -> Dict[str, Dict[int, str]]:
+        """
+        Завершение после окончания masscan: ожидание уже запущенных опросов
+        и получение баннеров всех оставшихся портов одной пачкой.
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+        self._ready.clear()
+        await asyncio.gather(*self._tasks)
+        
+        remaining = {}
+        for ip, ports in ports_by_ip.items():
+            known = self._services_by_ip.get(ip, {})
+            missing = [port for port in ports if port not in known]
+            if missing:
+                remaining[ip] = missing
+        if remaining:
+            await self._grab(remaining)
+        
+        if self._grabber._banner_cache:
+            self._grabber._evict_closed(ports_by_ip)
+        return {ip: {port: self._services_by_ip[ip][port] for port in ports} for ip, ports in ports_by_ip.items()}
+    
+    def cancel(self):
+        """Отмена ожидающих и запущенных опросов (masscan завершился без результатов)."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for task in self._tasks:
+            task.cancel()
         
 
 # === 5. Masscan Scanner Class ===
+@dataclass(slots=True)
+class PortRecord:
+    """Один открытый порт из результатов masscan."""
+    ip: str
+    port: int
+    protocol: str = 'tcp'
+    status: str = 'open'
+
+
+@lru_cache(maxsize=1)
+def _masscan_path() -> str:
+    """Поиск masscan в PATH один раз за процесс (без запуска подпроцесса)."""
+    path = shutil.which('masscan')
+    if not path:
+        logging.error("Ошибка при проверке наличия masscan: masscan не найден в PATH.")
+        sys.exit(1)
+    return path
+
+
+# Сколько секунд ждать завершения masscan после SIGTERM, прежде чем послать SIGKILL
+_MASSCAN_TERMINATE_TIMEOUT = 5
+# Размер блока чтения вывода masscan
+_MASSCAN_READ_CHUNK = 64 * 1024
+# Цели меньше этого числа адресов сканируются одним процессом: запуск шардов дороже выигрыша
+_MASSCAN_SHARD_MIN_IPS = 1024
+
+
+def _target_ip_count(target: str) -> int:
+    """
+    Число адресов в цели masscan: IP, подсеть CIDR или диапазон "a-b", через запятую.
+    Нераспознанная часть (например, имя хоста) считается большой, чтобы не отключать шардирование.
+    """
+    count = 0
+    for part in target.split(','):
+        part = part.strip()
+        try:
+            if '-' in part:
+                first, last = part.split('-', 1)
+                count += int(ipaddress.ip_address(last.strip())) - int(ipaddress.ip_address(first.strip())) + 1
+            else:
+                count += ipaddress.ip_network(part, strict=False).num_addresses
+        except ValueError:
+            return _MASSCAN_SHARD_MIN_IPS
+    return count
+
+
+@lru_cache(maxsize=1)
+def _masscan_has_raw_access(masscan_path: str) -> bool:
+    """
+    Проверка (best-effort), что masscan может работать с raw-сокетами без sudo:
+    процесс запущен от root либо бинарнику выданы capabilities через setcap.
+    """
+    if os.geteuid() == 0:
+        return True
+    
+    try:
+        result = subprocess.run(
+            ['getcap', masscan_path],
+            capture_output=True,
+            text=True,
+            timeout=5
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.debug(f"Не удалось проверить capabilities masscan: {e}")
+        return False
+    
+    return 'cap_net_raw' in result.stdout
+
+
 class MasscanScanner:
     """Сканирование портов с использованием masscan и обработка результатов."""
     
-    def __init__(self, rate: int = 1000, timeout: int = 5):
+    def __init__(self, rate: int = 1000, timeout: Optional[float] = None, auth_wrapper: List[str] = None, shards: int = 1,
+                 adapter_port: int = None):
         self.rate = rate
         self.timeout = timeout
+        # Префикс команды для повышения прав (например ["sudo", "-n"]), если нет root/capabilities.
+        # Команда ищется в PATH один раз: запуск по абсолютному пути не требует поиска при каждом сканировании
+        self.auth_wrapper = list(auth_wrapper or [])
+        if self.auth_wrapper:
+            self.auth_wrapper[0] = shutil.which(self.auth_wrapper[0]) or self.auth_wrapper[0]
+        # Число параллельных процессов masscan (--shards i/N); общий rate делится между ними
+        self.shards = max(1, shards)
+        # Первый исходный порт шардов: шард i использует adapter_port + i - 1
+        self.adapter_port = adapter_port
         self._check_masscan_installed()
         
     def _check_masscan_installed(self):
-        """Проверка установки masscan в системе."""
-        try:
-            result = subprocess.run(
-                ['sudo', 'which', 'masscan'], 
-                check=True,
-                capture_output=True,
-                timeout=self.timeout
-            )
-            
-            masscan_path = result.stdout.decode().strip()
-            logging.info(f"Masscan установлен и доступен по пути {masscan_path}.")  
-            
-        except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired) as e:
-            logging.error(f"Ошибка при проверке наличия masscan: {e}")
+        """Проверка установки masscan в системе и прав на raw-сокеты."""
+        masscan_path = _masscan_path()
+        if not os.access(masscan_path, os.X_OK):
+            logging.error(f"Masscan по пути {masscan_path} недоступен для запуска.")
             sys.exit(1)
-    
-    def scan(self, target: str, ports: str) -> List[Dict]:
-        """Выполнение сканирования с помощью masscan и возврат результатов."""
-        
-        logging.info(f"Запуск masscan для цели: {target} на портах: {ports} с rate: {self.rate}")
+        logging.info(f"Masscan установлен и доступен по пути {masscan_path}.")
         
-        # Временный файл для вывода результатов
-        output_file = f"app/scan_history/masscan_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        if not self.auth_wrapper and not _masscan_has_raw_access(masscan_path):
+            logging.warning(
+                "Masscan запускается без root и без capabilities. Выполните "
+                f"'sudo setcap cap_net_raw,cap_net_admin+eip {masscan_path}' "
+                "или укажите masscan_config.auth_wrapper."
+            )
+    
+    @staticmethod
+    def _parse_line(line: bytes) -> Optional[PortRecord]:
+        """
+        Разбор одной строки вывода masscan в формате list (-oL):
+        b"open tcp 80 1.1.1.1 1700000000". Поля фиксированы и разделены пробелами,
+        поэтому JSON-парсер не нужен. Строка разбирается как bytes, в str
+        декодируются только нужные поля. Комментарии (#) и прочие записи пропускаются.
+        """
+        parts = line.split()
+        if len(parts) < 4 or parts[0] != b'open':
+            return None
         
-        # Построение команды masscan
+        try:
+            return PortRecord(parts[3].decode('ascii'), int(parts[2]), parts[1].decode('ascii'), 'open')
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.debug("Ошибка разбора строки masscan (%r): %s", line.strip()[:50], e)
+            return None
+    
+    async def iter_scan(self, target: str, ports: str, shard: Tuple[int, int, int] = None) -> AsyncIterator[PortRecord]:
+        """
+        Запуск masscan и выдача открытых портов по мере их появления в stdout,
+        не дожидаясь окончания сканирования. Ненулевой код завершения (кроме 1)
+        приводит к subprocess.CalledProcessError.
+        shard - (номер, всего, seed) для запуска одной части шардированного сканирования.
+        """
+        # Построение команды masscan, результаты читаются из stdout по мере поступления.
+        # Используется найденный при запуске абсолютный путь, без поиска по PATH при каждом сканировании
         cmd = [
-            #'sudo', # Запуск от суперпользователя для доступа к низкоуровневым сетевым функциям
-            'masscan',
+            *self.auth_wrapper,
+            _masscan_path(),
             target,
             '-p', ports,
             '--rate', str(self.rate),
             '--open-only',
             '--wait', '0',
-            '--output-format', 'json',
-            '--output-filename', output_file
+            '--output-format', 'list',
+            '--output-filename', '-'
         ]
+        if shard:
+            index, total, seed = shard
+            # У всех частей общий seed: иначе разбиение адресов между шардами не согласовано
+            cmd[cmd.index('--rate') + 1] = str(max(1, self.rate // total))
+            cmd += ['--shards', f"{index}/{total}", '--seed', str(seed)]
+            if self.adapter_port:
+                # Свой исходный порт у каждого процесса: ответы не смешиваются между шардами
+                cmd += ['--adapter-port', str(self.adapter_port + index - 1)]
+        logging.info(f"Команда: {' '.join(cmd)}")
+        
+        # stderr пишется во временный файл: masscan постоянно выводит статус и может переполнить pipe
+        with tempfile.TemporaryFile() as stderr_file:
+            # Запуск через posix_spawn, как и у nmap (см. BannerGrabber._scan_hosts)
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=stderr_file,
+                close_fds=False
+            )
+            try:
+                # stdout читается блоками и делится на строки одним bytes.split,
+                # без отдельного await readline() на каждую строку
+                tail = b''
+                while chunk := await proc.stdout.read(_MASSCAN_READ_CHUNK):
+                    lines = (tail + chunk).split(b'\n')
+                    tail = lines.pop()
+                    for record in map(self._parse_line, lines):
+                        if record is not None:
+                            yield record
+                if tail:
+                    record = self._parse_line(tail)
+                    if record is not None:
+                        yield record
+                returncode = await proc.wait()
+            finally:
+                # Прерванное чтение (таймаут, отмена) не должно оставлять masscan работать.
+                # SIGTERM, а не SIGKILL: sudo передаёт его дочернему masscan
+                if proc.returncode is None:
+                    proc.terminate()
+                    try:
+                        await asyncio.wait_for(proc.wait(), _MASSCAN_TERMINATE_TIMEOUT)
+                    except TimeoutError:
+                        with contextlib.suppress(ProcessLookupError):
+                            proc.kill()
+            
+            if returncode not in [0, 1]:  # 0 - успешное выполнение, 1 - некоторые хосты недоступны
+                stderr_file.seek(0)
+                raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr_file.read().decode('utf-8', errors='replace'))
+    
+    @staticmethod
+    async def _collect(records: AsyncIterator[PortRecord], sink: Callable[[PortRecord], None]):
+        """Передача результатов в sink сразу при получении."""
+        async for record in records:
+            sink(record)
+    
+    async def _scan_sharded(self, target: str, ports: str, sink: Callable[[PortRecord], None]):
+        """
+        Параллельный запуск self.shards процессов masscan, каждый сканирует свою часть
+        пространства адресов и портов. Результаты всех частей передаются в общий sink.
+        """
+        seed = random.getrandbits(32)
+        
+        def collect(index: int):
+            return self._collect(self.iter_scan(target, ports, shard=(index, self.shards, seed)), sink)
+        
+        tasks = [asyncio.ensure_future(collect(index)) for index in range(1, self.shards + 1)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # При ошибке одной части остальные процессы masscan останавливаются
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def scan(self, target: str, ports: str,
+                   on_record: Optional[Callable[[PortRecord], None]] = None) -> Tuple[List[PortRecord], bool]:
+        """
+        Выполнение сканирования с помощью masscan и возврат результатов:
+        (открытые порты, сканирование выполнено полностью).
+        on_record получает каждый открытый порт сразу при его появлении в выводе masscan.
+        self.timeout (None - без ограничения) ограничивает время работы masscan целиком:
+        по его истечении masscan останавливается и возвращаются уже найденные порты
+        с признаком неполного сканирования.
+        """
+        
+        logging.info(f"Запуск masscan для цели: {target} на портах: {ports} с rate: {self.rate}")
+        
+        results = []
         
+        def sink(record: PortRecord):
+            results.append(record)
+            if on_record is not None:
+                on_record(record)
+        
+        sharded = self.shards > 1 and _target_ip_count(target) >= _MASSCAN_SHARD_MIN_IPS
+        complete = True
         try:
-            logging.info(f"Команда: {' '.join(cmd)}")
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True
+            async with asyncio.timeout(self.timeout):
+                if sharded:
+                    await self._scan_sharded(target, ports, sink)
+                else:
+                    await self._collect(self.iter_scan(target, ports), sink)
+        except TimeoutError:
+            # Найденные порты не отбрасываются: иначе следующий цикл сочтёт их все новыми
+            complete = False
+            logging.warning(
+                "Masscan не завершил сканирование %s за %s секунд (masscan_config.timeout), "
+                "результат может быть неполным.", target, self.timeout
             )
-
-            if result.returncode not in [0, 1]:  # 0 - успешное выполнение, 1 - некоторые хосты недоступны
-                logging.error(f"Ошибка при выполнении masscan: {result.stderr}")
-                return []
-            
-            if not Path(output_file).exists():
-                logging.warning("Файл с результатами сканирования не был создан.")
-                return []
-            
-            with open(output_file, 'r', encoding='utf-8') as f:
-                scan_results_lines = f.readlines()
-                
-            results = []
-            
-            for line in scan_results_lines:
-                line = line.strip()
-                if not line or line in [',', '[', ']', '{', '}']:
-                    continue
-                if line.endswith(','):
-                    line = line[:-1]
-                if len(line) < 10:
-                    continue
-                    
-                try:
-                    data = json.loads(line)
-                    if 'ip' in data and 'ports' in data:
-                        for port_info in data['ports']:
-                            results.append({
-                                'ip': data['ip'],
-                                'port': port_info['port'],
-                                'protocol': port_info.get('proto', 'tcp'),
-                                'status': port_info.get('status', 'open')
-                            })
-                except json.JSONDecodeError as e:
-                    logging.debug(f"Ошибка парсинга JSON (строка: '{line[:50]}'): {e}")
-                    continue
-                
-            try:
-                os.remove(output_file)
-            except OSError as e:
-                logging.warning(f"Не удалось удалить временный файл: {e}")
-                
-            logging.info(f"Masscan завершил сканирование. Найдено {len(results)} открытых портов.")
-            return results
-
-        except subprocess.TimeoutExpired:
-            logging.error(f"Время ожидания истекло при выполнении masscan {self.timeout} секунд.")
-            return []
-        except Exception as e:
-            logging.error(f"Неизвестная ошибка при выполнении masscan: {e}")
-            return []
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Ошибка при выполнении masscan: {e.stderr}")
+            return [], False
+        except OSError as e:
+            logging.error(f"Не удалось запустить masscan: {e}")
+            return [], False
+        
+        if sharded:
+            # Части сканируют разные адреса, но повтор записи при пересечении не нужен
+            results = list({(record.ip, record.port, record.protocol): record for record in results}.values())
+        logging.info(f"Masscan завершил сканирование. Найдено {len(results)} открытых портов.")
+        return results, complete
         
 
 # === 6. Scan History Class ===
+# С какого числа портов на IP сравнение выполняется через numpy (если установлен)
+_NUMPY_MIN_PORTS = 1024
+# После скольких записей журнал переносится в JSON файл, не дожидаясь конца цикла сканирования
+_JOURNAL_COMPACT_RECORDS = 10000
+# Версия формата строк сервисов в истории: 3 - первая строка баннера (для HTTP - протокол и Server),
+# Nmap - только для портов без баннера; источник каждого сервиса хранится в services_source.
+# У IP без services_format сервисы записаны в формате Nmap "name product version", у версии 2 -
+# HTTP записан строкой статуса
+_SERVICES_FORMAT = 3
+
+
+def _sorted_unique_ports(ports: List[int]) -> array:
+    """Отсортированные уникальные порты в array('H'); большие списки обрабатываются через np.unique."""
+    if np is not None and len(ports) >= _NUMPY_MIN_PORTS:
+        return array('H', np.unique(np.asarray(ports, dtype=np.uint16)).tobytes())
+    return array('H', sorted(set(ports)))
+
+
+def _ports_difference(ports: array, other: array) -> List[int]:
+    """Порты из ports, которых нет в other (оба массива отсортированы и без повторов)."""
+    if np is not None and len(ports) >= _NUMPY_MIN_PORTS:
+        return np.setdiff1d(
+            np.frombuffer(ports, dtype=np.uint16), np.frombuffer(other, dtype=np.uint16), assume_unique=True
+        ).tolist()
+    return sorted(set(ports).difference(other))
+
+
 class ScanHistory:
-    """Управление историей сканирований и хранение данных о найденных портах."""
+    """
+    Управление историей сканирований и хранение данных о найденных портах.
+    В памяти порты хранятся отдельно от остальных данных IP: отсортированный
+    array('H') на IP (2 байта на порт) вместо списка объектов int.
+    
+    Каждое обновление IP дописывается в журнал (history_file + ".log") одной строкой
+    с разницей относительно предыдущего состояния: добавленные и удалённые порты,
+    изменившиеся сервисы. Полный JSON переписывается только при flush(), после
+    чего журнал очищается.
+    
+    Для открытых портов хранится время получения баннера (services_ts), чтобы кэш
+    BannerGrabber переживал перезапуск. В журнал оно не пишется и сохраняется
+    только вместе с полным JSON.
+    
+    services_format IP - версия формата строк сервисов (_SERVICES_FORMAT). Сервисы,
+    записанные в другом формате, не сравниваются с текущими: смена формата не является
+    изменением сервиса. services_source - источник сервиса каждого порта (баннер или
+    запасной вариант); сервисы разных источников тоже не сравниваются.
+    """
     
     def __init__(self, history_file: str = "app/scan_history/scan_history.json"):
         self.history_file = history_file
+        self.journal_file = history_file + ".log"
+        self._journal = None
+        self._journal_records = 0
+        # Записи журнала, ожидающие фоновой записи, и задача-писатель (см. _append_journal)
+        self._journal_queue: asyncio.Queue = None
+        self._journal_writer: asyncio.Task = None
+        # Есть изменения, ещё не записанные в JSON файл (см. flush)
+        self._dirty = False
+        # Хэш содержимого JSON файла на диске: одинаковое содержимое не переписывается
+        self._saved_digest = None
         self.data = self._load_history()
+        self._replay_journal()
+        # Порты по IP; в self.data остаются только first/last_scanned и services
+        self._ports: Dict[str, array] = {
+            ip: _sorted_unique_ports(ip_data.pop("ports", [])) for ip, ip_data in self.data.items()
+        }
         
     def _load_history(self) -> dict:
         """Загрузка истории сканирований из JSON файла."""
@@ -487,127 +1548,415 @@ class ScanHistory:
             return {}
         
         try:
-            with open(self.history_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(self.history_file, 'rb') as f:
+                raw = f.read()
+            data = _json_loads(raw)
+            self._saved_digest = hashlib.blake2b(raw, digest_size=16).digest()
+            return data
         except json.JSONDecodeError as e:
             logging.error(f"Ошибка парсинга JSON в файле истории создаём новую историю: {e}")
             return {}
         
-    def _save_history(self):
-        """Сохранение истории сканирований в JSON файл."""
+    def _replay_journal(self):
+        """Применение к загруженной истории обновлений из журнала, не попавших в JSON файл."""
+        if not Path(self.journal_file).exists():
+            return
         
+        replayed = 0
+        with open(self.journal_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = _json_loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная последняя строка после аварийного завершения
+                    logging.warning("Повреждённая запись в журнале истории пропущена.")
+                    continue
+                
+                ip_data = self.data.setdefault(record["ip"], {
+                    "first_scanned": record.get("first_scanned", record["last_scanned"]),
+                    "services": {}
+                })
+                if "ports" in record:
+                    # Полная запись журнала прежнего формата
+                    ip_data["ports"] = record["ports"]
+                elif "added" in record or "removed" in record:
+                    ports = set(ip_data.get("ports", [])).difference(record.get("removed", []))
+                    ports.update(record.get("added", []))
+                    ip_data["ports"] = sorted(ports)
+                ip_data.setdefault("services", {}).update(record.get("services", {}))
+                ip_data["last_scanned"] = record["last_scanned"]
+                if "services_ts" in record:
+                    # Журнал прежней версии, где записывалось и время баннеров
+                    ip_data["services_ts"] = record["services_ts"]
+                if "services_format" in record:
+                    ip_data["services_format"] = record["services_format"]
+                if "services_source" in record:
+                    ip_data.setdefault("services_source", {}).update(record["services_source"])
+                replayed += 1
+        
+        if replayed:
+            logging.info(f"Из журнала истории восстановлено {replayed} обновлений.")
+            self._journal_records = replayed
+            self._dirty = True
+    
+    def _append_journal(self, record: dict):
+        """
+        Дозапись одного обновления в журнал истории (O(1) вместо перезаписи всего файла).
+        Внутри цикла событий запись передаётся фоновой задаче, которая пишет все накопившиеся
+        записи одним вызовом write; без цикла событий запись выполняется сразу.
+        """
+        data = _json_dumps(record, newline=True)
+        self._journal_records += 1
         try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            logging.error(f"Ошибка при сохранении истории сканирований: {e}")
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_journal([data])
+            return
         
-    def get_previous_ports(self, ip: str) -> set:
-        """Получение множества ранее найденных портов для данного IP."""
-        return set(self.data.get(ip, {}).get("ports", []))
+        if self._journal_writer is None or self._journal_writer.done():
+            self._journal_queue = asyncio.Queue()
+            self._journal_writer = asyncio.create_task(self._journal_writer_loop())
+        self._journal_queue.put_nowait(data)
+    
+    async def _journal_writer_loop(self):
+        """Фоновая задача записи журнала: накопившиеся в очереди записи пишутся пачкой."""
+        while True:
+            batch = [await self._journal_queue.get()]
+            while not self._journal_queue.empty():
+                batch.append(self._journal_queue.get_nowait())
+            self._write_journal(batch)
+    
+    def _drain_journal_queue(self):
+        """Немедленная запись записей журнала, ещё не обработанных фоновой задачей."""
+        if self._journal_queue is None or self._journal_queue.empty():
+            return
+        batch = []
+        while not self._journal_queue.empty():
+            batch.append(self._journal_queue.get_nowait())
+        self._write_journal(batch)
+    
+    def _write_journal(self, batch: List[bytes]):
+        """Запись пачки строк журнала одним вызовом write."""
+        try:
+            if self._journal is None:
+                self._journal = open(self.journal_file, 'ab')
+            self._journal.write(b"".join(batch))
+            self._journal.flush()
+        except OSError as e:
+            logging.error(f"Ошибка записи в журнал истории: {e}")
+    
+    def _clear_journal(self):
+        """Удаление журнала после того, как все его записи попали в JSON файл."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._journal_records = 0
+        try:
+            os.remove(self.journal_file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Не удалось удалить журнал истории: {e}")
+    
+    def _save_history(self):
+        """
+        Сохранение истории сканирований в JSON файл.
+        Запись идёт во временный файл (с fsync) с последующим атомарным os.replace,
+        чтобы прерванная запись не оставила повреждённую историю.
+        Если содержимое совпадает с уже записанным, файл не переписывается.
+        """
+        tmp_file = self.history_file + ".tmp"
+        try:
+            data = _json_dumps(self._serialize(), indent=True)
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            if digest == self._saved_digest:
+                logging.debug("История сканирований не изменилась, запись пропущена.")
+                return True
+            
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.history_file)
+            self._saved_digest = digest
+        except (OSError, TypeError) as e:
+            logging.error(f"Ошибка при сохранении истории сканирований: {e}")
+            return False
+        return True
     
-    def update_ports(self, ip: str, ports: List[int], services: dict):
-        """Обновление информации о портах для указанного IP."""
+    def _serialize(self) -> dict:
+        """Сборка истории в формате файла: массивы портов возвращаются в списки."""
+        return {
+            ip: {**ip_data, "ports": self._ports.get(ip, array('H')).tolist()}
+            for ip, ip_data in self.data.items()
+        }
+    
+    def flush(self):
+        """
+        Запись накопленных изменений истории в JSON файл (один раз за цикл сканирования всех целей
+        либо при переполнении журнала) и очистка журнала.
+        """
+        # Записи, ещё не дошедшие до журнала, должны попасть в файл до его удаления
+        self._drain_journal_queue()
+        if not self._dirty:
+            return
+        if self._save_history():
+            self._clear_journal()
+            self._dirty = False
+    
+    async def close(self):
+        """Завершение работы с историей перед выходом: сохранение изменений и остановка фоновой записи."""
+        self.flush()
+        if self._journal_writer is not None:
+            self._journal_writer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._journal_writer
+            self._journal_writer = None
+        self._drain_journal_queue()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        
+    def get_previous_ports(self, ip: str) -> array:
+        """Получение отсортированного массива ранее найденных портов для данного IP."""
+        return self._ports.get(ip, array('H'))
+    
+    def get_banner_keys(self) -> set:
+        """Порты, сервис которых в истории получен из баннера: {(ip, port)}."""
+        return {
+            (ip, int(port_str))
+            for ip, ip_data in self.data.items()
+            for port_str, source in ip_data.get("services_source", {}).items()
+            if source == _SOURCE_BANNER
+        }
+    
+    def get_cached_services(self) -> Dict[Tuple[str, int], Tuple[float, str]]:
+        """Сохранённые баннеры открытых портов со временем их получения: (ip, port) -> (время, сервис)."""
+        entries = {}
+        for ip, ip_data in self.data.items():
+            services = ip_data.get("services", {})
+            for port_str, ts in ip_data.get("services_ts", {}).items():
+                if port_str in services:
+                    entries[(ip, int(port_str))] = (ts, services[port_str])
+        return entries
+    
+    def update_ports(self, ip: str, ports: List[int], services: dict, scan_ts: str = None,
+                     services_ts: Dict[int, float] = None, complete: bool = True,
+                     sources: Dict[str, str] = None):
+        """
+        Обновление информации о портах для указанного IP. scan_ts - общее время обработки сканирования,
+        services_ts - время получения баннеров текущих открытых портов,
+        sources - источник сервиса портов (_SOURCE_BANNER / _SOURCE_FALLBACK).
+        complete=False - сканирование прервано по таймауту: ports может быть лишь частью открытых
+        портов, поэтому порты только добавляются, а не пропавшие из результата не удаляются.
+        """
+        scan_ts = scan_ts or _now_str()
+        # Запись журнала содержит только разницу с предыдущим состоянием IP
+        record = {"ip": ip, "last_scanned": scan_ts}
         if ip not in self.data:
             self.data[ip] = {
-                "first_scanned": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                "ports": [],
+                "first_scanned": scan_ts,
                 "services": {}
             }
+            record["first_scanned"] = scan_ts
+        if self.data[ip].get("services_format") != _SERVICES_FORMAT:
+            # Сервисы IP теперь записаны в текущем формате
+            self.data[ip]["services_format"] = record["services_format"] = _SERVICES_FORMAT
             
-        self.data[ip]["ports"] = sorted(list(set(ports)))
-        self.data[ip]["services"].update(services)
-        self.data[ip]["last_scanned"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self._save_history()
+        previous_ports = self._ports.get(ip, array('H'))
+        current_ports = _sorted_unique_ports(ports if complete else [*ports, *previous_ports])
+        # Массив заменяется только при изменении набора портов
+        if current_ports != previous_ports:
+            self._ports[ip] = current_ports
+            record["added"] = _ports_difference(current_ports, previous_ports)
+            record["removed"] = _ports_difference(previous_ports, current_ports)
+        
+        previous_services = self.data[ip]["services"]
+        changed_services = {port: service for port, service in services.items() if previous_services.get(port) != service}
+        if changed_services:
+            previous_services.update(changed_services)
+            record["services"] = changed_services
+        if sources:
+            previous_sources = self.data[ip].setdefault("services_source", {})
+            changed_sources = {port: source for port, source in sources.items() if previous_sources.get(port) != source}
+            if changed_sources:
+                previous_sources.update(changed_sources)
+                record["services_source"] = changed_sources
+        self.data[ip]["last_scanned"] = scan_ts
+        self._dirty = True
+        
+        if services_ts is not None:
+            # Заменяется целиком: время хранится только для открытых сейчас портов
+            # (при неполном сканировании - дополняется).
+            # Время баннеров обновляется каждый цикл, поэтому в журнал не пишется и попадает
+            # в JSON только при flush(); после аварийного завершения баннеры просто опрашиваются заново
+            current_ts = {str(port): ts for port, ts in services_ts.items()}
+            if not complete:
+                current_ts = {**self.data[ip].get("services_ts", {}), **current_ts}
+            self.data[ip]["services_ts"] = current_ts
+        
+        # Если у IP не изменились порты и сервисы, журнал не пишется:
+        # last_scanned и время баннеров попадут в JSON при flush()
+        if record.keys() - {"ip", "last_scanned"}:
+            self._append_journal(record)
+            # Ограничение размера журнала при очень больших сканированиях
+            if self._journal_records >= _JOURNAL_COMPACT_RECORDS:
+                self.flush()
         
     def find_new_ports(self, ip: str, current_ports: List[int]) -> List[int]:
-        """Определение новых портов, которых не было в предыдущих сканированиях."""
-        previous_p = self.get_previous_ports(ip)
-        current_p = set(current_ports)
-        new_ports = current_p - previous_p
-        return sorted(list(new_ports))
-    
-    def find_changed_services(self, ip: str, current_services: dict) -> dict:
-        """Определение портов, на которых изменились сервисы."""
-        if ip not in self.data:
+        """
+        Определение новых портов, которых не было в предыдущих сканированиях.
+        Для больших списков используется битовая карта всех 65536 портов в numpy.
+        """
+        previous_ports = self.get_previous_ports(ip)
+        
+        if np is not None and len(current_ports) >= _NUMPY_MIN_PORTS:
+            current = np.asarray(current_ports, dtype=np.uint16)
+            seen = np.zeros(65536, dtype=bool)
+            if len(previous_ports):
+                seen[np.frombuffer(previous_ports, dtype=np.uint16)] = True
+            return np.unique(current[~seen[current]]).tolist()
+        
+        new_ports = set(current_ports).difference(previous_ports)
+        return sorted(new_ports)
+    
+    def find_new_ports_bulk(self, ports_by_ip: Dict[str, List[int]]) -> Dict[str, List[int]]:
+        """
+        Определение новых портов сразу для всех IP результата сканирования.
+        При наличии numpy пары (IP, порт) кодируются в uint64 (индекс IP << 16 | порт)
+        и сравниваются с историей одним вызовом np.isin вместо отдельного сравнения на каждый IP.
+        """
+        total_ports = sum(len(ports) for ports in ports_by_ip.values())
+        if np is None or total_ports < _NUMPY_MIN_PORTS:
+            return {ip: self.find_new_ports(ip, ports) for ip, ports in ports_by_ip.items()}
+        
+        ips = list(ports_by_ip)
+        current_keys = np.concatenate([
+            (np.uint64(idx) << np.uint64(16)) | np.asarray(ports_by_ip[ip], dtype=np.uint64)
+            for idx, ip in enumerate(ips)
+        ])
+        previous = [
+            (np.uint64(idx) << np.uint64(16)) | np.frombuffer(previous_ports, dtype=np.uint16).astype(np.uint64)
+            for idx, previous_ports in enumerate(map(self.get_previous_ports, ips)) if len(previous_ports)
+        ]
+        previous_keys = np.concatenate(previous) if previous else np.empty(0, dtype=np.uint64)
+        
+        # np.unique сортирует ключи, поэтому новые порты уже сгруппированы по индексу IP
+        new_keys = np.unique(current_keys[~np.isin(current_keys, previous_keys)])
+        ip_indexes = new_keys >> np.uint64(16)
+        new_ports = (new_keys & np.uint64(0xFFFF)).tolist()
+        bounds = np.searchsorted(ip_indexes, np.arange(len(ips) + 1, dtype=np.uint64)).tolist()
+        return {ip: new_ports[bounds[idx]:bounds[idx + 1]] for idx, ip in enumerate(ips)}
+    
+    def find_changed_services(self, ip: str, current_services: dict, sources: Dict[str, str] = None) -> dict:
+        """
+        Определение портов, на которых изменились сервисы.
+        Ключи current_services - строки номеров портов, как в сохранённой истории.
+        sources - источник текущих сервисов: сервис из баннера не сравнивается с сохранённым
+        запасным значением (и наоборот), это не смена сервиса, а другой способ его определения.
+        """
+        ip_data = self.data.get(ip)
+        if ip_data is None:
+            return {}
+        if ip_data.get("services_format") != _SERVICES_FORMAT:
+            # Сервисы записаны в прежнем формате Nmap: отличие от баннера - не изменение сервиса
+            logging.debug("Сервисы %s в истории записаны в прежнем формате, сравнение пропущено.", ip)
             return {}
         
-        previous_services = self.data[ip].get("services", {})
+        previous_services = ip_data.get("services", {})
+        previous_sources = ip_data.get("services_source", {})
+        sources = sources or {}
         changed = {}
         
         for port, new_service in current_services.items():
-            port_str = str(port)
-            old_service = previous_services.get(port_str, "")
+            old_service = previous_services.get(port, "")
             
-            # Сравниваем новый сервис со старым
+            # Сравниваем новый сервис со старым, если оба определены одним способом
             if old_service and old_service != new_service:
+                old_source, new_source = previous_sources.get(port), sources.get(port)
+                if old_source and new_source and old_source != new_source:
+                    logging.debug("Сервис %s:%s определён другим способом (%s -> %s), сравнение пропущено.",
+                                  ip, port, old_source, new_source)
+                    continue
                 changed[port] = (old_service, new_service)
         
         return changed
 
 
 # === 7. Port Scanner Orchestrator Class ===
+# Длинные синхронные циклы обработки результатов отдают управление циклу событий не реже, чем раз
+# в столько секунд, чтобы одна большая цель не задерживала остальные; время проверяется раз в _YIELD_CHECK_EVERY шагов
+_YIELD_SLICE = 0.1
+_YIELD_CHECK_EVERY = 4096
+# Вес времени ожидания цели при выборе порядка сканирования (остальное - длительность её сканирования)
+_TARGET_AGE_WEIGHT = 0.3
+
 class PortScannerOrchestrator:
     """Координация всех компонентов для выполнения сканирования портов."""
     
     def __init__(self, config_path: str = "config.json"):
-        self.config = Config(config_path)
-        self.history = ScanHistory()
-        self.masscan_scanner = MasscanScanner(
-            rate=self.config.masscan_rate,
-            timeout=self.config.masscan_timeout
-            )
-        self.notifier = TelegramNotifier()
-        self.banner_grabber = BannerGrabber()
-
-    async def process_scan_result(self, results: List[Dict], target_name: str, is_scheduled: bool = False) -> dict:
-        """
-        Обработка результатов сканирования:
-        - Группировка по IP
-        - Получение баннеров для каждого порта
-        - Сравнение с историей
-        - Возврат информации об изменениях
-        
-        Возвращает словарь с информацией об изменениях для каждого IP
-        """
-        if not results:
-            logging.info("Нет открытых портов для обработки.")
-            return {}
-        
-        # Группировка результатов по IP
-        ports_by_ip: Dict[str, List[int]] = {}
-        
-        for result in results:
-            ip = result['ip']
-            port = result['port']
+        # Компоненты независимо читают диск (история, .env, поиск masscan и nmap),
+        # поэтому создаются параллельно: время запуска - максимум, а не сумма.
+        # Первыми запускаются не зависящие от конфига, затем - использующие его параметры
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            history_future = executor.submit(ScanHistory)
+            notifier_future = executor.submit(TelegramNotifier)
+            self.config = Config(config_path)
             
-            if ip not in ports_by_ip:
-                ports_by_ip[ip] = []
-            ports_by_ip[ip].append(port)
+            masscan_future = executor.submit(
+                MasscanScanner,
+                rate=self.config.masscan_rate,
+                timeout=self.config.masscan_timeout,
+                auth_wrapper=self.config.masscan_auth_wrapper,
+                shards=self.config.masscan_shards,
+                adapter_port=self.config.masscan_adapter_port
+                )
+            # При сканировании по расписанию порт опрашивается раз в _BANNER_RECHECK_CYCLES циклов,
+            # стабильный - раз в _BANNER_STABLE_RECHECK_CYCLES. Срок кэша меньше кратного интервала
+            # на половину интервала: запас на неточность расписания и длительность сканирования
+            interval = self.config.schedule_interval_hours * 3600 if self.config.schedule_enabled else 0
+            cache_ttl = interval * (_BANNER_RECHECK_CYCLES - 0.5)
+            stable_ttl = interval * (_BANNER_STABLE_RECHECK_CYCLES - 0.5)
+            banner_future = executor.submit(BannerGrabber, cache_ttl=cache_ttl,
+                                            nmap_concurrency=self.config.nmap_concurrency, stable_ttl=stable_ttl)
             
-        logging.info(f"Обнаружено {len(ports_by_ip)} уникальных IP адресов с открытыми портами.")
-        
-        changes_detected = {}
-        
-        # Обработка каждого IP
-        for ip, ports in ports_by_ip.items():
+            # result() пробрасывает исключения (и sys.exit) из потоков создания компонентов
+            self.history = history_future.result()
+            self.notifier = notifier_future.result()
+            self.masscan_scanner = masscan_future.result()
+            self.banner_grabber = banner_future.result()
+        self.banner_grabber.load_cache(self.history.get_cached_services(), self.history.get_banner_keys())
+        # Ограничение числа одновременно обрабатываемых IP и защита общей истории
+        self._ip_semaphore = asyncio.Semaphore(8)
+        self._history_lock = asyncio.Lock()
+        # Время окончания и длительность последнего сканирования каждой цели (по часам цикла событий)
+        self._target_last_scanned: Dict[str, float] = {}
+        self._target_durations: Dict[str, float] = {}
+
+    async def _process_ip(self, ip: str, ports: List[int], port_services: Dict[int, str], new_ports: List[int],
+                          target_name: str, is_scheduled: bool, scan_ts: str, complete: bool = True) -> dict:
+        """Сравнение результатов одного IP с историей и отправка уведомлений."""
+        async with self._ip_semaphore:
             logging.info("="*60)
-            logging.info(f"Обработка {target_name} c IP: {ip} с портами: {ports}")
+            logging.info("Обработка %s c IP: %s с портами: %s", target_name, ip, ports)
             logging.info("="*60)
-            logging.info(f"Сканирование {len(ports)} портов на {ip}...")
             
-            services_int_keys = self.banner_grabber.identify_open_ports(ip, ports)
+            services = {str(port): service_info for port, service_info in port_services.items()}
             
-            services = {str(port): service_info for port, service_info in services_int_keys.items()}
+            # Строка на каждый порт: форматирование откладывается до проверки уровня логирования
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                for port, service_info in services.items():
+                    logging.info("-> %s:%s/tcp: %s", ip, port, service_info)
             
-            for port, service_info in services.items():
-                logging.info(f"-> {ip}:{port}/tcp: {service_info}")
-            
-            # Определение новых портов
-            new_ports = self.history.find_new_ports(ip, ports)
-            
-            # Определение измененных сервисов
-            changed_services = self.history.find_changed_services(ip, services)
+            async with self._history_lock:
+                # Определение измененных сервисов (новые порты найдены заранее для всех IP)
+                sources = self.banner_grabber.service_sources(ip, ports)
+                changed_services = self.history.find_changed_services(ip, services, sources)
+                
+                # Обновление истории сканирования
+                services_ts = self.banner_grabber.cache_timestamps(ip, ports) if self.banner_grabber.cache_ttl > 0 else None
+                self.history.update_ports(ip, ports, services, scan_ts=scan_ts, services_ts=services_ts,
+                                          complete=complete, sources=sources)
             
             ip_changes = {
                 'has_new_ports': bool(new_ports),
@@ -619,17 +1968,18 @@ class PortScannerOrchestrator:
             }
             
             if is_scheduled:
-                # При плановом сканировании отправляем только если есть изменения
+                # При плановом сканировании отправляем только если есть изменения,
+                # все изменения IP - одним сообщением
                 if new_ports:
                     logging.warning(f"Обнаружены НОВЫЕ открытые порты на {ip}: {new_ports}")
-                    await self.notifier.notify_new_ports(ip, new_ports, services)
                 
                 if changed_services:
                     logging.warning(f"На {ip} изменились сервисы: {changed_services}")
-                    await self.notifier.notify_changed_services(ip, changed_services)
                 
-                if not new_ports and not changed_services:
-                    logging.info(f"На {ip} нет изменений (новых портов и измененных сервисов).")
+                if new_ports or changed_services:
+                    await self.notifier.notify_ip_changes(ip, new_ports, changed_services, services, scan_ts=scan_ts)
+                else:
+                    logging.info("На %s нет изменений (новых портов и измененных сервисов).", ip)
             else:
                 # При разовом сканировании собираем информацию без отправки
                 if new_ports:
@@ -640,10 +1990,60 @@ class PortScannerOrchestrator:
                 
                 logging.info(f"История сканирования для {ip} обновлена (режим разового сканирования).")
             
-            # Обновление истории сканирования
-            self.history.update_ports(ip, ports, services)
+            return ip_changes
+
+    async def process_scan_result(self, results: List[PortRecord], target_name: str, is_scheduled: bool = False,
+                                  banners: _BannerStream = None, complete: bool = True) -> dict:
+        """
+        Обработка результатов сканирования:
+        - Группировка по IP
+        - Получение баннеров для каждого порта
+        - Сравнение с историей
+        - Возврат информации об изменениях
+        
+        complete=False - masscan прерван по таймауту: из истории порты не удаляются.
+        Возвращает словарь с информацией об изменениях для каждого IP
+        """
+        if not results:
+            logging.info("Нет открытых портов для обработки.")
+            return {}
+        
+        # Группировка результатов по IP
+        ports_by_ip: Dict[str, List[int]] = defaultdict(list)
+        
+        loop = asyncio.get_running_loop()
+        slice_start = loop.time()
+        for idx, result in enumerate(results, 1):
+            ports_by_ip[result.ip].append(result.port)
+            if not idx % _YIELD_CHECK_EVERY and loop.time() - slice_start > _YIELD_SLICE:
+                await asyncio.sleep(0)
+                slice_start = loop.time()
             
-            changes_detected[ip] = ip_changes
+        logging.info(f"Обнаружено {len(ports_by_ip)} уникальных IP адресов с открытыми портами.")
+        
+        # Баннеры всех IP и портов собираются параллельно, до обработки истории
+        total_ports = sum(len(ports) for ports in ports_by_ip.values())
+        logging.info(f"Получение баннеров для {total_ports} портов на {len(ports_by_ip)} IP...")
+        if banners is not None:
+            # Часть баннеров уже получена во время работы masscan
+            services_by_ip = await banners.finish(ports_by_ip)
+        else:
+            services_by_ip = await self.banner_grabber.grab_all(ports_by_ip)
+        
+        # Единое время для всех записей истории и уведомлений этого сканирования
+        scan_ts = _now_str()
+        
+        # Новые порты определяются одним проходом по всем IP до обновления истории
+        async with self._history_lock:
+            new_ports_by_ip = self.history.find_new_ports_bulk(ports_by_ip)
+        
+        # IP обрабатываются параллельно: уведомления по разным хостам не ждут друг друга
+        ip_changes_list = await asyncio.gather(*(
+            self._process_ip(ip, ports, services_by_ip[ip], new_ports_by_ip[ip], target_name, is_scheduled, scan_ts,
+                             complete)
+            for ip, ports in ports_by_ip.items()
+        ))
+        changes_detected = dict(zip(ports_by_ip, ip_changes_list))
         
         return changes_detected
             
@@ -666,17 +2066,24 @@ class PortScannerOrchestrator:
         if not is_scheduled:
             await self.notifier.notify_scan_start(target_name, target, ports)
         
-        # Выполнение сканирования masscan
-        scan_results = self.masscan_scanner.scan(target, ports)
+        # Выполнение сканирования masscan; баннеры IP начинают собираться, не дожидаясь его окончания
+        banners = self.banner_grabber.stream()
+        try:
+            scan_results, complete = await self.masscan_scanner.scan(target, ports, on_record=banners.add)
+        except BaseException:
+            banners.cancel()
+            raise
         
         if not scan_results:
+            banners.cancel()
             logging.info("Сканирование завершено. Открытых портов не обнаружено.")
             if not is_scheduled:
                 await self.notifier.notify_scan_results_single(target_name, target, {})
             return {}
         
         # Обработка результатов сканирования (возвращает информацию об изменениях)
-        changes = await self.process_scan_result(scan_results, target_name, is_scheduled=is_scheduled)
+        changes = await self.process_scan_result(scan_results, target_name, is_scheduled=is_scheduled, banners=banners,
+                                                 complete=complete)
         
         # Для разового сканирования отправляем полную информацию
         if not is_scheduled and scan_results:
@@ -695,6 +2102,26 @@ class PortScannerOrchestrator:
         
         return changes
 
+    def _order_targets(self, targets: List[Dict[str, Any]], now: float) -> List[Dict[str, Any]]:
+        """
+        Порядок сканирования целей, когда их больше, чем max_concurrent_targets.
+        Приоритет - взвешенная сумма времени с последнего сканирования цели (вес _TARGET_AGE_WEIGHT)
+        и её пропускной способности (быстрые цели раньше): давно не сканированные цели
+        не откладываются бесконечно, а короткие не ждут за длинными.
+        Ни разу не сканированные цели идут первыми в порядке конфига.
+        """
+        if len(targets) <= self.config.max_concurrent_targets:
+            return targets
+        
+        def priority(target_config: Dict[str, Any]) -> float:
+            target = target_config["target"]
+            if target not in self._target_last_scanned:
+                return float('inf')
+            age = now - self._target_last_scanned[target]
+            return age * _TARGET_AGE_WEIGHT - self._target_durations[target] * (1 - _TARGET_AGE_WEIGHT)
+        
+        return sorted(targets, key=priority, reverse=True)
+    
     async def run_all_scans(self, is_scheduled: bool = False):
         """Запуск сканирования для всех целей из конфигурации."""
         
@@ -705,14 +2132,29 @@ class PortScannerOrchestrator:
         logging.info(f"Начало сканирования всех целей. Всего целей: {total_targets}")
         logging.info("="*60)
         
-        for idx, target_config in enumerate(targets, 1):
-            try:
-                logging.info(f">>> Сканирование цели {idx} из {total_targets} <<<")
-                await self.run_scan(target_config, is_scheduled=is_scheduled)
-            except Exception as e:
-                target_name = target_config.get("name", "Unknown")
-                logging.error(f"Ошибка при сканировании цели {target_name}: {e}", exc_info=True)
-                continue
+        # Цели сканируются параллельно, не более max_concurrent_targets одновременно
+        semaphore = asyncio.Semaphore(self.config.max_concurrent_targets)
+        loop = asyncio.get_running_loop()
+        
+        async def run_target(idx: int, target_config: Dict[str, str]):
+            async with semaphore:
+                started = loop.time()
+                try:
+                    logging.info(f">>> Сканирование цели {idx} из {total_targets} <<<")
+                    await self.run_scan(target_config, is_scheduled=is_scheduled)
+                except Exception as e:
+                    target_name = target_config.get("name", "Unknown")
+                    logging.error(f"Ошибка при сканировании цели {target_name}: {e}", exc_info=True)
+                finally:
+                    self._target_last_scanned[target_config["target"]] = loop.time()
+                    self._target_durations[target_config["target"]] = loop.time() - started
+        
+        # Семафор пропускает цели в порядке запуска, поэтому порядок задаёт, какие цели начнут первыми
+        ordered_targets = self._order_targets(targets, loop.time())
+        await asyncio.gather(*(run_target(idx, target_config) for idx, target_config in enumerate(ordered_targets, 1)))
+        
+        # Сохранение истории одним файлом после обработки всех целей цикла
+        self.history.flush()
         
         logging.info("="*60)
         logging.info("Сканирование всех целей завершено.")
@@ -753,9 +2195,15 @@ class PortScannerOrchestrator:
         
         scan_count = 0
         total_cycles = 0
+        # Циклы привязаны к фиксированной сетке: интервал отсчитывается от начала
+        # предыдущего цикла, а не от его окончания, поэтому длительность сканирования не накапливается.
+        # Сроки считаются по часам цикла событий (монотонным), которые не зависят от перевода системного времени
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
         
         try:
             while True:
+                deadline += interval_seconds
                 total_cycles += 1
                 logging.info("="*60)
                 logging.info(f"Цикл сканирования #{total_cycles} начат.")
@@ -769,22 +2217,33 @@ class PortScannerOrchestrator:
                     previous_ports = self.history.get_previous_ports(target)
                     scan_count += len(previous_ports)
                 
-                next_scan_time = datetime.now().timestamp() + interval_seconds
-                next_scan_datetime = datetime.fromtimestamp(next_scan_time).strftime('%Y-%m-%d %H:%M:%S')
-                logging.info(f"Следующее сканирование запланировано на: {next_scan_datetime}")
-                logging.info(f"Ожидание {interval} часов до следующего сканирования...\n")
+                delay = deadline - loop.time()
+                if delay <= 0:
+                    # Сканирование длилось дольше интервала: следующий цикл сразу, сетка сдвигается
+                    logging.warning(f"Цикл сканирования #{total_cycles} превысил интервал на {-delay:.0f} сек.")
+                    deadline = loop.time()
+                    delay = 0
+                
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    logging.info("Следующее сканирование запланировано на: %s", _format_ts(int(time.time() + delay)))
+                    logging.info("Ожидание %.2f часов до следующего сканирования...\n", delay / 3600)
                 
+                # Ожидание до абсолютного срока: таймер срабатывает один раз в момент deadline
+                wake = asyncio.Event()
+                handle = loop.call_at(deadline, wake.set)
                 try:
-                    await asyncio.sleep(interval_seconds)
-                except (KeyboardInterrupt, asyncio.CancelledError):
-                    raise KeyboardInterrupt()
+                    await wake.wait()
+                finally:
+                    handle.cancel()
                 
-        except KeyboardInterrupt:
+        except asyncio.CancelledError:
+            # Остановка (Ctrl+C, SIGTERM) приходит как отмена задачи в точке ожидания
             logging.info(">>> Сканирование остановлено пользователем.")
             logging.info(f"Статистика: {total_cycles} циклов, {scan_count} проверок")
             
             # Отправляем финальное уведомление в Telegram
             await self.notifier.notify_schedule_stopped(scan_count, total_cycles)
+            raise
             
             
 # === 8. Main Entry Point ===
@@ -799,15 +2258,42 @@ async def main():
     logging.info("="*60)
     
     orchestrator = PortScannerOrchestrator(config_path="app/config.json")
-    await orchestrator.run_scheduled_scans()
+    
+    # SIGINT и SIGTERM отменяют задачу сканирования: остановка проходит через CancelledError
+    # в ближайшей точке ожидания, без KeyboardInterrupt в произвольном месте кода
+    task = asyncio.create_task(orchestrator.run_scheduled_scans())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):  # Windows: обработчики сигналов цикла недоступны
+            loop.add_signal_handler(sig, task.cancel)
+    
+    try:
+        await task
+    except asyncio.CancelledError:
+        # Отмена самой main (а не остановка по сигналу) передаётся дальше
+        if asyncio.current_task().cancelling():
+            raise
+        logging.info("Сканирование остановлено по сигналу.")
+    finally:
+        # Сообщения, поставленные в очередь без ожидания отправки, отправляются до выхода
+        await orchestrator.notifier.close()
+        await orchestrator.history.close()
 
     
 if __name__ == "__main__":
+    exit_code = 0
     try:
-        asyncio.run(main())
+        # uvloop (libuv) быстрее стандартного цикла событий на сетевом вводе-выводе и работе с подпроцессами
+        (uvloop.run if uvloop is not None else asyncio.run)(main())
+    except KeyboardInterrupt:
+        # Ctrl+C до установки обработчиков сигналов или там, где они недоступны (Windows)
+        pass
     except Exception as e:
         logging.error(f"Критическая ошибка: {e}", exc_info=True)
-        sys.exit(1)
+        exit_code = 1
     finally:
         logging.info("="*60)
-        logging.info(">>> Программа завершена\n")
\ No newline at end of file
+        logging.info(">>> Программа завершена\n")
+        # Единственная точка завершения логирования: очередь дописывается до выхода
+        shutdown_logging()
+    sys.exit(exit_code)
\ No newline at end of file
@@ -0,0 +1,446 @@
+"""Тесты app/masscan_scaner.py (запуск: python -m unittest discover tests)."""
+
+import asyncio
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+import masscan_scaner as ms
+
+
+class MasscanScannerTimeoutTest(unittest.TestCase):
+    """Истечение masscan_config.timeout не отбрасывает уже найденные порты."""
+
+    def _scanner(self, timeout: float) -> ms.MasscanScanner:
+        with mock.patch.object(ms.MasscanScanner, "_check_masscan_installed"):
+            return ms.MasscanScanner(rate=1000, timeout=timeout)
+
+    def test_timeout_returns_partial_results(self):
+        scanner = self._scanner(timeout=0.2)
+        records = [ms.PortRecord("10.0.0.1", 80, "tcp", "open"), ms.PortRecord("10.0.0.2", 22, "tcp", "open")]
+
+        async def iter_scan(target, ports, shard=None):
+            for record in records:
+                yield record
+            # masscan продолжает работу дольше таймаута
+            await asyncio.sleep(10)
+
+        streamed = []
+        with mock.patch.object(scanner, "iter_scan", iter_scan):
+            results, complete = asyncio.run(scanner.scan("10.0.0.0/30", "1-1000", on_record=streamed.append))
+
+        self.assertEqual(results, records)
+        self.assertFalse(complete)
+        self.assertEqual(streamed, records)
+
+    def test_masscan_error_returns_nothing(self):
+        scanner = self._scanner(timeout=5)
+
+        async def iter_scan(target, ports, shard=None):
+            yield ms.PortRecord("10.0.0.1", 80, "tcp", "open")
+            raise ms.subprocess.CalledProcessError(2, ["masscan"], stderr="fail")
+
+        with mock.patch.object(scanner, "iter_scan", iter_scan):
+            self.assertEqual(asyncio.run(scanner.scan("10.0.0.1", "80")), ([], False))
+
+    def test_no_timeout_means_no_cap(self):
+        scanner = self._scanner(timeout=None)
+
+        async def iter_scan(target, ports, shard=None):
+            await asyncio.sleep(0.1)
+            yield ms.PortRecord("10.0.0.1", 80, "tcp", "open")
+
+        with mock.patch.object(scanner, "iter_scan", iter_scan):
+            results, complete = asyncio.run(scanner.scan("10.0.0.1", "80"))
+        self.assertEqual(results, [ms.PortRecord("10.0.0.1", 80, "tcp", "open")])
+        self.assertTrue(complete)
+
+
+class BannerStabilityTest(unittest.TestCase):
+    """Стабильным считается только порт с подряд одинаковым определённым сервисом."""
+
+    KEY = ("10.0.0.1", 8081)
+
+    def setUp(self):
+        with mock.patch.object(ms.BannerGrabber, "_check_nmap_installed", return_value="/usr/bin/nmap"):
+            self.grabber = ms.BannerGrabber(cache_ttl=60, stable_ttl=600)
+
+    def _observe(self, service: str, times: int = ms._BANNER_STABLE_SCANS):
+        for _ in range(times):
+            self.grabber._update_stability(self.KEY, service)
+
+    def test_same_banner_becomes_stable(self):
+        self._observe("SSH-2.0-OpenSSH_9.6", ms._BANNER_STABLE_SCANS - 1)
+        self.assertEqual(self.grabber._entry_ttl(self.KEY), 60)
+        self._observe("SSH-2.0-OpenSSH_9.6", 1)
+        self.assertEqual(self.grabber._entry_ttl(self.KEY), 600)
+
+    def test_changed_banner_resets_counter(self):
+        self._observe("SSH-2.0-OpenSSH_9.6", ms._BANNER_STABLE_SCANS - 1)
+        self._observe("SSH-2.0-OpenSSH_9.7", 1)
+        self.assertEqual(self.grabber._stable[self.KEY], ("SSH-2.0-OpenSSH_9.7", 1))
+        self.assertEqual(self.grabber._entry_ttl(self.KEY), 60)
+
+    def test_unresolved_results_never_stable(self):
+        for service in ("Нет ответа", "Закрыт (filtered)", "Порт не сканирован", "Ошибка сканирования (Nmap)"):
+            with self.subTest(service=service):
+                self._observe(service)
+                self.assertNotIn(self.KEY, self.grabber._stable)
+                self.assertEqual(self.grabber._entry_ttl(self.KEY), 60)
+
+    def test_unresolved_result_resets_stable_port(self):
+        self._observe("SSH-2.0-OpenSSH_9.6")
+        self._observe("Нет ответа", 1)
+        self.assertEqual(self.grabber._entry_ttl(self.KEY), 60)
+
+    def test_sources_follow_banner_and_fallback(self):
+        async def grab(ip, port):
+            return "SSH-2.0-OpenSSH_9.6" if port == 22 else ""
+
+        with mock.patch.object(self.grabber, "grab", grab):
+            services = asyncio.run(self.grabber.identify_open_ports_multi({"10.0.0.1": [22, 80]}))
+        self.assertEqual(services, {"10.0.0.1": {22: "SSH-2.0-OpenSSH_9.6", 80: "http"}})
+        self.assertEqual(self.grabber.service_sources("10.0.0.1", [22, 80]),
+                         {"22": ms._SOURCE_BANNER, "80": ms._SOURCE_FALLBACK})
+
+
+class BannerNormalizeTest(unittest.TestCase):
+    """Строка сервиса не зависит от изменчивых частей ответа."""
+
+    def test_http_reply_keeps_protocol_and_server(self):
+        ok = b"HTTP/1.1 200 OK\r\nDate: Thu, 01 Jan 2026 00:00:00 GMT\r\nServer: nginx/1.24.0\r\n\r\n"
+        unavailable = b"HTTP/1.1 503 Service Unavailable\r\nserver: nginx/1.24.0\r\n\r\n"
+        self.assertEqual(ms.BannerGrabber._normalize_banner(ok), "HTTP/1.1 nginx/1.24.0")
+        self.assertEqual(ms.BannerGrabber._normalize_banner(unavailable), "HTTP/1.1 nginx/1.24.0")
+
+    def test_http_reply_without_server(self):
+        self.assertEqual(ms.BannerGrabber._normalize_banner(b"HTTP/1.0 301 Moved Permanently\r\n\r\n"), "HTTP/1.0")
+
+    def test_other_banners(self):
+        self.assertEqual(ms.BannerGrabber._normalize_banner(b"\r\nSSH-2.0-OpenSSH_9.6\r\n"), "SSH-2.0-OpenSSH_9.6")
+        self.assertEqual(ms.BannerGrabber._normalize_banner(b"\x15\x03\x01\x00\x02\x02\x50"), "")
+        self.assertEqual(ms.BannerGrabber._normalize_banner(b""), "")
+
+
+class ScanHistoryServicesFormatTest(unittest.TestCase):
+    """Сервисы из истории прежнего формата (Nmap) не считаются изменившимися."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.history_file = str(Path(self.tmp.name) / "scan_history.json")
+
+    def _history(self, data: dict) -> ms.ScanHistory:
+        Path(self.history_file).write_bytes(ms._json_dumps(data))
+        history = ms.ScanHistory(self.history_file)
+        self.addCleanup(lambda: history._journal and history._journal.close())
+        return history
+
+    def test_old_format_is_migrated_without_changes(self):
+        history = self._history({"10.0.0.1": {
+            "first_scanned": "2026-01-01 00:00:00", "last_scanned": "2026-01-01 00:00:00",
+            "ports": [80], "services": {"80": "http nginx 1.24.0"},
+        }})
+        banners = {"80": "HTTP/1.1 200 OK"}
+        self.assertEqual(history.find_changed_services("10.0.0.1", banners), {})
+
+        history.update_ports("10.0.0.1", [80], banners)
+        self.assertEqual(history.data["10.0.0.1"]["services_format"], ms._SERVICES_FORMAT)
+        self.assertEqual(
+            history.find_changed_services("10.0.0.1", {"80": "HTTP/1.1 404 Not Found"}),
+            {"80": ("HTTP/1.1 200 OK", "HTTP/1.1 404 Not Found")},
+        )
+
+    def test_format_survives_journal_replay(self):
+        history = self._history({})
+        history.update_ports("10.0.0.1", [80], {"80": "HTTP/1.1 200 OK"})
+        history._journal.flush()
+
+        replayed = ms.ScanHistory(self.history_file)
+        self.assertEqual(replayed.data["10.0.0.1"]["services_format"], ms._SERVICES_FORMAT)
+
+
+    def test_services_from_different_sources_are_not_compared(self):
+        history = self._history({})
+        history.update_ports("10.0.0.1", [80, 22], {"80": "HTTP/1.1 nginx", "22": "SSH-2.0-OpenSSH_9.6"},
+                             sources={"80": ms._SOURCE_BANNER, "22": ms._SOURCE_BANNER})
+
+        # Медленный HTTP-сервис определён по таблице стандартных портов
+        self.assertEqual(history.find_changed_services(
+            "10.0.0.1", {"80": "http", "22": "SSH-2.0-OpenSSH_9.7"},
+            {"80": ms._SOURCE_FALLBACK, "22": ms._SOURCE_BANNER},
+        ), {"22": ("SSH-2.0-OpenSSH_9.6", "SSH-2.0-OpenSSH_9.7")})
+
+        history.update_ports("10.0.0.1", [80], {"80": "http"}, sources={"80": ms._SOURCE_FALLBACK})
+        self.assertEqual(history.find_changed_services("10.0.0.1", {"80": "HTTP/1.1 nginx"}, {"80": ms._SOURCE_BANNER}), {})
+        self.assertEqual(history.get_banner_keys(), {("10.0.0.1", 22)})
+
+
+class ScanHistoryJournalTest(unittest.TestCase):
+    """В журнал попадают только изменения портов и сервисов."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.history = ms.ScanHistory(str(Path(tmp.name) / "scan_history.json"))
+        self.addCleanup(lambda: self.history._journal and self.history._journal.close())
+
+    def test_banner_timestamps_alone_are_not_journalled(self):
+        services = {"22": "SSH-2.0-OpenSSH_9.6"}
+        self.history.update_ports("10.0.0.1", [22], services, services_ts={22: 1000.0})
+        self.assertEqual(self.history._journal_records, 1)
+
+        self.history.update_ports("10.0.0.1", [22], services, services_ts={22: 2000.0})
+        self.assertEqual(self.history._journal_records, 1)
+        self.assertEqual(self.history.data["10.0.0.1"]["services_ts"], {"22": 2000.0})
+
+        self.history.flush()
+        saved = ms._json_loads(Path(self.history.history_file).read_bytes())
+        self.assertEqual(saved["10.0.0.1"]["services_ts"], {"22": 2000.0})
+        self.assertFalse(Path(self.history.journal_file).exists())
+
+
+    def test_incomplete_scan_only_adds_ports(self):
+        self.history.update_ports("10.0.0.1", [22, 80, 443], {"22": "SSH-2.0-OpenSSH_9.6"})
+        self.history.update_ports("10.0.0.1", [80, 8080], {}, complete=False)
+
+        self.assertEqual(self.history.get_previous_ports("10.0.0.1").tolist(), [22, 80, 443, 8080])
+        self.assertEqual(self.history.find_new_ports("10.0.0.1", [22, 443]), [])
+
+
+class TelegramFormatTest(unittest.TestCase):
+    """Текст удалённой стороны и конфигурации не становится HTML-разметкой сообщения."""
+
+    def setUp(self):
+        self.notifier = ms.TelegramNotifier()
+
+    def test_new_port_banner_is_escaped(self):
+        message = self.notifier._format_new_ports(
+            "10.0.0.1", [110], {"110": "+OK POP3 server ready <1896.697170952@host>"}, "2026-01-01 00:00:00"
+        )
+        self.assertIn("+OK POP3 server ready &lt;1896.697170952@host&gt;", message)
+        self.assertNotIn("<1896", message)
+
+    def test_changed_service_both_sides_escaped(self):
+        message = self.notifier._format_changed_services(
+            "10.0.0.1", {"25": ("220 <mx.example.com> ESMTP", "220 mx & relay")}, "2026-01-01 00:00:00"
+        )
+        self.assertIn("Было: 220 &lt;mx.example.com&gt; ESMTP", message)
+        self.assertIn("Стало: 220 mx &amp; relay", message)
+
+    def test_target_name_is_escaped(self):
+        sent = []
+
+        async def send_message(message, flush=False, wait=True):
+            sent.append(message)
+            return True
+
+        with mock.patch.object(self.notifier, "send_message", send_message):
+            asyncio.run(self.notifier.notify_scan_start("<Офис>", "10.0.0.0/24", "80"))
+        self.assertIn("<b>Цель:</b> &lt;Офис&gt;", sent[0])
+
+
+class TelegramQueueTest(unittest.TestCase):
+    """Очередь отправки: изоляция отклонённых сообщений и постановка в очередь без ожидания."""
+
+    def setUp(self):
+        self.notifier = ms.TelegramNotifier()
+        self.sent = []
+        notifier = self
+
+        class Bot:
+            async def send_message(self, chat_id, text, parse_mode):
+                if "reject" in text:
+                    raise ms.BadRequest("Can't parse entities")
+                notifier.sent.append(text)
+
+        async def get_bot():
+            return Bot()
+
+        self.notifier._get_bot = get_bot
+        patcher = mock.patch.object(ms, "TELEGRAM_BATCH_INTERVAL", 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rejected_batch_is_resent_one_by_one(self):
+        async def run():
+            return await asyncio.gather(
+                self.notifier.send_message("first"),
+                self.notifier.send_message("reject me"),
+                self.notifier.send_message("third"),
+            )
+
+        self.assertEqual(asyncio.run(run()), [True, False, True])
+        self.assertEqual(self.sent, ["first", "third"])
+
+    def test_enqueue_without_waiting(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            self.assertTrue(await self.notifier.send_message("queued", wait=False))
+            enqueue_time = loop.time() - started
+            self.assertEqual(self.sent, [])
+            await self.notifier.close()
+            return enqueue_time
+
+        self.assertLess(asyncio.run(run()), 0.05)
+        self.assertEqual(self.sent, ["queued"])
+
+
+class ScanHistoryReplayTest(unittest.TestCase):
+    """Журнал хранит разницу состояний IP и восстанавливает историю после аварийного завершения."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.history_file = str(Path(tmp.name) / "scan_history.json")
+
+    def test_added_and_removed_ports_are_replayed(self):
+        Path(self.history_file).write_bytes(ms._json_dumps({"10.0.0.1": {
+            "first_scanned": "2026-01-01 00:00:00", "last_scanned": "2026-01-01 00:00:00",
+            "ports": [22, 80, 443], "services": {"22": "ssh"},
+        }}))
+        history = ms.ScanHistory(self.history_file)
+        history.update_ports("10.0.0.1", [22, 8080, 443], {"8080": "HTTP/1.1 Jetty"}, scan_ts="2026-01-02 00:00:00")
+        history.update_ports("10.0.0.2", [3306], {"3306": "mysql"}, scan_ts="2026-01-02 00:00:00")
+        history._journal.close()
+
+        journal = [ms._json_loads(line) for line in Path(history.journal_file).read_bytes().splitlines()]
+        self.assertEqual(journal[0]["added"], [8080])
+        self.assertEqual(journal[0]["removed"], [80])
+        self.assertNotIn("ports", journal[0])
+
+        # JSON файл не переписывался: состояние восстанавливается только из журнала
+        replayed = ms.ScanHistory(self.history_file)
+        self.addCleanup(lambda: replayed._journal and replayed._journal.close())
+        self.assertEqual(replayed.get_previous_ports("10.0.0.1").tolist(), [22, 443, 8080])
+        self.assertEqual(replayed.get_previous_ports("10.0.0.2").tolist(), [3306])
+        self.assertEqual(replayed.data["10.0.0.1"]["services"], {"22": "ssh", "8080": "HTTP/1.1 Jetty"})
+        self.assertEqual(replayed.data["10.0.0.1"]["last_scanned"], "2026-01-02 00:00:00")
+        self.assertEqual(replayed.data["10.0.0.2"]["first_scanned"], "2026-01-02 00:00:00")
+
+    def test_truncated_journal_line_is_skipped(self):
+        history = ms.ScanHistory(self.history_file)
+        history.update_ports("10.0.0.1", [22], {"22": "ssh"})
+        history._journal.close()
+        with open(history.journal_file, "ab") as f:
+            f.write(b'{"ip": "10.0.0.1", "added": [2')
+
+        replayed = ms.ScanHistory(self.history_file)
+        self.addCleanup(lambda: replayed._journal and replayed._journal.close())
+        self.assertEqual(replayed.get_previous_ports("10.0.0.1").tolist(), [22])
+
+
+class FindNewPortsBulkTest(unittest.TestCase):
+    """Новые порты сразу для всех IP: упаковка (IP, порт) в uint64 и разбиение результата по IP."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.history = ms.ScanHistory(str(Path(tmp.name) / "scan_history.json"))
+        self.addCleanup(lambda: self.history._journal and self.history._journal.close())
+        self.history.update_ports("10.0.0.1", list(range(1, 1001)), {})
+        self.history.update_ports("10.0.0.3", [65535], {})
+
+    def _expected(self, ports_by_ip):
+        return {ip: self.history.find_new_ports(ip, ports) for ip, ports in ports_by_ip.items()}
+
+    def test_small_scan_uses_sets(self):
+        ports_by_ip = {"10.0.0.1": [80, 2000], "10.0.0.2": [22]}
+        self.assertEqual(self.history.find_new_ports_bulk(ports_by_ip), {"10.0.0.1": [2000], "10.0.0.2": [22]})
+
+    @unittest.skipIf(ms.np is None, "numpy не установлен")
+    def test_large_scan_splits_keys_by_ip(self):
+        ports_by_ip = {
+            "10.0.0.1": list(range(500, 1600)),          # 1001-1599 новые
+            "10.0.0.2": [443, 22, 443],                   # новый IP, повтор порта
+            "10.0.0.3": [65535, 0],                       # граничные значения порта
+            "10.0.0.4": list(range(1, 11)),
+        }
+        result = self.history.find_new_ports_bulk(ports_by_ip)
+
+        self.assertEqual(list(result), list(ports_by_ip))
+        self.assertEqual(result["10.0.0.1"], list(range(1001, 1600)))
+        self.assertEqual(result["10.0.0.2"], [22, 443])
+        self.assertEqual(result["10.0.0.3"], [0])
+        self.assertEqual(result["10.0.0.4"], list(range(1, 11)))
+        self.assertEqual(result, self._expected(ports_by_ip))
+
+    @unittest.skipIf(ms.np is None, "numpy не установлен")
+    def test_large_scan_without_new_ports(self):
+        ports_by_ip = {"10.0.0.1": list(range(1, 1001)), "10.0.0.3": [65535]}
+        self.assertEqual(self.history.find_new_ports_bulk(ports_by_ip), {"10.0.0.1": [], "10.0.0.3": []})
+
+
+class SplitMessageTest(unittest.TestCase):
+    """Деление длинных сообщений на части не длиннее лимита Telegram."""
+
+    def test_short_message_is_not_split(self):
+        self.assertEqual(ms.TelegramNotifier._split_message("привет\n"), ["привет\n"])
+
+    def test_split_on_line_boundaries(self):
+        line = "x" * 1000 + "\n"
+        chunks = ms.TelegramNotifier._split_message(line * 9)
+        self.assertEqual([len(chunk) for chunk in chunks], [4004, 4004, 1001])
+        self.assertEqual("".join(chunks), line * 9)
+
+    def test_overlong_line_is_cut(self):
+        message = "a\n" + "y" * 9000 + "\nb\n"
+        chunks = ms.TelegramNotifier._split_message(message)
+        self.assertTrue(all(len(chunk) <= ms.TELEGRAM_MESSAGE_LIMIT for chunk in chunks))
+        self.assertEqual(chunks[0], "a\n")
+        self.assertEqual("".join(chunks), message)
+
+
+class TakeBatchTest(unittest.TestCase):
+    """Объединение сообщений очереди в пачку и перенос не поместившегося в следующую."""
+
+    def setUp(self):
+        self.notifier = ms.TelegramNotifier()
+        self.notifier._queue = asyncio.Queue()
+
+    def test_messages_that_fit_are_joined(self):
+        for text in ("b", "c"):
+            self.notifier._queue.put_nowait((text, None))
+        batch = self.notifier._take_batch(("a", None))
+        self.assertEqual([text for text, _ in batch], ["a", "b", "c"])
+        self.assertIsNone(self.notifier._carry)
+        self.assertTrue(self.notifier._queue.empty())
+
+    def test_overflow_is_carried_in_order(self):
+        half = "h" * 2045
+        for text in (half, "next", "last"):
+            self.notifier._queue.put_nowait((text, None))
+        batch = self.notifier._take_batch((half, None))
+
+        # Две половины с разделителем помещаются в лимит, третье сообщение - уже нет
+        self.assertEqual([text for text, _ in batch], [half, half])
+        self.assertEqual(self.notifier._carry, ("next", None))
+        self.assertEqual(self.notifier._queue.get_nowait(), ("last", None))
+
+        size = len(ms.TELEGRAM_BATCH_SEPARATOR.join(text for text, _ in batch))
+        self.assertLessEqual(size, ms.TELEGRAM_MESSAGE_LIMIT)
+
+
+class TargetIpCountTest(unittest.TestCase):
+    """Число адресов цели masscan (решение о шардировании)."""
+
+    def test_single_address_and_networks(self):
+        self.assertEqual(ms._target_ip_count("10.0.0.1"), 1)
+        self.assertEqual(ms._target_ip_count("10.0.0.0/22"), 1024)
+        self.assertEqual(ms._target_ip_count("10.0.0.5/24"), 256)
+
+    def test_ranges_and_lists(self):
+        self.assertEqual(ms._target_ip_count("10.0.0.1-10.0.0.10"), 10)
+        self.assertEqual(ms._target_ip_count("10.0.0.1, 10.0.1.0/30,10.0.2.0 - 10.0.2.1"), 7)
+
+    def test_unparsable_target_allows_sharding(self):
+        self.assertEqual(ms._target_ip_count("scanme.example.com"), ms._MASSCAN_SHARD_MIN_IPS)
+
+
+if __name__ == "__main__":
+    unittest.main()